@@ -0,0 +1,129 @@
+"""Schema-aware packing of cashu JSON bodies for the LXMF transport.
+
+Cashu bodies are mostly hex strings (points, secrets, keyset ids) under a
+handful of field names that repeat for every proof and output. pack()
+turns the known hex fields into raw bytes and the known field names into
+one byte integers, unpack() rebuilds exactly the same JSON object, so the
+proxy can hand the mint a standard request.
+"""
+
+# Field names of cashu requests and responses. On the wire each name is
+# sent as a negative integer (-1 for the first one, ...), so the order of
+# this tuple is part of the wire format: never reorder, only append.
+KEYS = (
+    "id",
+    "amount",
+    "secret",
+    "C",
+    "B_",
+    "C_",
+    "dleq",
+    "e",
+    "s",
+    "r",
+    "witness",
+    "proofs",
+    "outputs",
+    "promises",
+    "pr",
+    "spendable",
+    "pending",
+    "keysets",
+    "paid",
+    "preimage",
+    "change",
+    "detail",
+    "code",
+    "hash",
+    "payment_hash",
+    "fee",
+    "states",
+    "Y",
+    "state",
+    "quote",
+    "unit",
+    "name",
+    "pubkey",
+    "version",
+    "description",
+    "description_long",
+    "contact",
+    "motd",
+    "nuts",
+    "parameter",
+    "signatures",
+    "current",
+    "active",
+    "keys",
+)
+
+KEY_CODES = {name: -(i + 1) for i, name in enumerate(KEYS)}
+
+# Fields that hold hex strings: 33 byte points, 32 byte secrets, keyset ids
+HEX_KEYS = {
+    "id",
+    "secret",
+    "C",
+    "B_",
+    "C_",
+    "e",
+    "s",
+    "r",
+    "preimage",
+    "payment_hash",
+    "pubkey",
+    "Y",
+    "current",
+    "active",
+}
+
+HEX_CHARS = set("0123456789abcdef")
+
+
+def _is_hex(value):
+    # Only lowercase hex roundtrips through bytes.hex() unchanged
+    return len(value) > 0 and len(value) % 2 == 0 and set(value) <= HEX_CHARS
+
+
+def _is_amount(key):
+    # Keysets are maps of amount (as a decimal string) to a public key
+    return isinstance(key, str) and key.isdigit() and str(int(key)) == key
+
+
+def _pack_key(key):
+    if key in KEY_CODES:
+        return KEY_CODES[key]
+    if _is_amount(key):
+        return int(key)
+    return key
+
+
+def _unpack_key(key):
+    if isinstance(key, int):
+        if key < 0:
+            return KEYS[-key - 1]
+        return str(key)
+    return key
+
+
+def pack(obj, key=None):
+    """Packs a JSON object (as returned by json.loads) into a compact form
+    that msgpack serializes efficiently."""
+    if isinstance(obj, dict):
+        return {_pack_key(k): pack(v, k) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [pack(v, key) for v in obj]
+    if isinstance(obj, str) and (key in HEX_KEYS or _is_amount(key)) and _is_hex(obj):
+        return bytes.fromhex(obj)
+    return obj
+
+
+def unpack(obj):
+    """Rebuilds the JSON object from the output of pack()."""
+    if isinstance(obj, dict):
+        return {_unpack_key(k): unpack(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [unpack(v) for v in obj]
+    if isinstance(obj, bytes):
+        return obj.hex()
+    return obj
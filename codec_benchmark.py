@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""Compares the number of bytes that go over the radio for the legacy JSON
+transport and the binary envelope, using real cashu payloads.
+
+    python3 codec_benchmark.py
+"""
+
+import hashlib
+import json
+
+import RNS.vendor.umsgpack as umsgpack
+
+from cashu.core.crypto import b_dhke
+from cashu.core.crypto.keys import derive_keys, derive_keyset_id, derive_pubkeys
+from cashu.core.crypto.secp import PrivateKey
+
+import lxmf_codec
+from lxmf_codec import encode_request, encode_response
+
+
+def deterministic_secret(i):
+    return hashlib.sha256(f"nutband benchmark {i}".encode()).hexdigest()
+
+
+def deterministic_key(i):
+    return PrivateKey(hashlib.sha256(f"key {i}".encode()).digest(), raw=True)
+
+
+def mint_keys():
+    private_keys = derive_keys("nutband benchmark mint", "m/0'/0'/0'")
+    return derive_pubkeys(private_keys)
+
+
+def keys_response(public_keys):
+    return {str(amt): key.serialize().hex() for amt, key in public_keys.items()}
+
+
+def split_payloads(public_keys, keyset_id, n_proofs=3, n_outputs=8):
+    proofs = []
+    for i in range(n_proofs):
+        amount = 2**i
+        C_, _ = b_dhke.step1_alice(deterministic_secret(i), deterministic_key(i))
+        proofs.append(
+            {
+                "id": keyset_id,
+                "amount": amount,
+                "secret": deterministic_secret(i),
+                "C": C_.serialize().hex(),
+            }
+        )
+    outputs = []
+    promises = []
+    for i in range(n_outputs):
+        amount = 2 ** (i % 3)
+        B_, _ = b_dhke.step1_alice(deterministic_secret(100 + i))
+        outputs.append({"amount": amount, "B_": B_.serialize().hex()})
+        C_, e, s = b_dhke.step2_bob(B_, deterministic_key(i))
+        promises.append(
+            {
+                "id": keyset_id,
+                "amount": amount,
+                "C_": C_.serialize().hex(),
+                "dleq": {"e": e.serialize(), "s": s.serialize()},
+            }
+        )
+    return {"proofs": proofs, "outputs": outputs}, {"promises": promises}
+
+
+def check_payloads(n_proofs=3):
+    request = {"proofs": [{"secret": deterministic_secret(i)} for i in range(n_proofs)]}
+    response = {"spendable": [True] * n_proofs, "pending": [False] * n_proofs}
+    return request, response
+
+
+def legacy_request_size(method, path, json_body=None):
+    """Size of content + fields, as the legacy transport puts them in LXMF"""
+    fields = {"req_id": "abcd", "method": method}
+    if json_body is not None:
+        fields["json"] = json_body
+    return len(path) + len(umsgpack.packb(fields))
+
+
+def envelope_request_size(method, path, variant, json_body=None):
+    codec, schema = variant
+    fields = {
+        "req_id": "abcd",
+        lxmf_codec.FIELD_ENVELOPE: encode_request(
+            method, path, codec, json=json_body, schema=schema
+        ),
+    }
+    return len(umsgpack.packb(fields))
+
+
+def legacy_response_size(body):
+    return len(json.dumps(body)) + len(umsgpack.packb({"req_id": "abcd"}))
+
+
+def envelope_response_size(body, variant):
+    codec, schema = variant
+    fields = {
+        "req_id": "abcd",
+        lxmf_codec.FIELD_ENVELOPE: encode_response(
+            200, json.dumps(body), codec, schema
+        ),
+    }
+    return len(umsgpack.packb(fields))
+
+
+def main():
+    public_keys = mint_keys()
+    keyset_id = derive_keyset_id(public_keys)
+    split_request, split_response = split_payloads(public_keys, keyset_id)
+    check_request, check_response = check_payloads()
+
+    codecs = [
+        (name, codec)
+        for name, codec in (
+            ("none", lxmf_codec.CODEC_NONE),
+            ("zlib", lxmf_codec.CODEC_ZLIB),
+            ("zstd", lxmf_codec.CODEC_ZSTD),
+        )
+        if codec in lxmf_codec.supported_codecs()
+    ]
+    # every codec once with plain msgpack bodies and once with cashu packing
+    codecs = [("env+" + name, (codec, None)) for name, codec in codecs] + [
+        ("cashu+" + name, (codec, lxmf_codec.SCHEMA_CASHU)) for name, codec in codecs
+    ]
+
+    rows = [
+        (
+            "GET /keys request",
+            legacy_request_size("GET", "/keys"),
+            [envelope_request_size("GET", "/keys", c) for _, c in codecs],
+        ),
+        (
+            "GET /keys response",
+            legacy_response_size(keys_response(public_keys)),
+            [envelope_response_size(keys_response(public_keys), c) for _, c in codecs],
+        ),
+        (
+            "POST /split request",
+            legacy_request_size("POST", "/split", split_request),
+            [
+                envelope_request_size("POST", "/split", c, split_request)
+                for _, c in codecs
+            ],
+        ),
+        (
+            "POST /split response",
+            legacy_response_size(split_response),
+            [envelope_response_size(split_response, c) for _, c in codecs],
+        ),
+        (
+            "POST /check request",
+            legacy_request_size("POST", "/check", check_request),
+            [
+                envelope_request_size("POST", "/check", c, check_request)
+                for _, c in codecs
+            ],
+        ),
+        (
+            "POST /check response",
+            legacy_response_size(check_response),
+            [envelope_response_size(check_response, c) for _, c in codecs],
+        ),
+    ]
+
+    header = f"{'payload':<22}{'json':>8}" + "".join(
+        f"{name:>12}" for name, _ in codecs
+    )
+    print(header)
+    print("-" * len(header))
+    for name, legacy, sizes in rows:
+        line = f"{name:<22}{legacy:>8}"
+        for size in sizes:
+            line += f"{size:>7} {100 * size // legacy:>3}%"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Picks the LXMF delivery method of a message from its size.
+
+An OPPORTUNISTIC message is a single encrypted packet. A DIRECT message
+goes over a link, which costs a link request, a proof and an RTT packet to
+set up if there is none yet, and carries content that does not fit in a
+link packet as a resource. Small requests and replies are cheapest as one
+opportunistic packet. Everything else, or anything sent while a link to
+the peer is up anyway, goes DIRECT.
+"""
+
+import collections
+import math
+import time
+
+import LXMF
+import RNS
+import RNS.vendor.umsgpack as umsgpack
+
+from request_tracking import format_req_id
+
+OPPORTUNISTIC = LXMF.LXMessage.OPPORTUNISTIC
+DIRECT = LXMF.LXMessage.DIRECT
+
+# messages sent over a session (see lxmf_session.py) are logged as this
+SESSION = "session"
+
+METHOD_NAMES = {OPPORTUNISTIC: "opportunistic", DIRECT: "direct"}
+
+# link request, link proof and the RTT packet
+LINK_SETUP_PACKETS = 3
+# resource advertisement and the proof of the whole resource
+RESOURCE_OVERHEAD_PACKETS = 2
+
+
+def content_size(title, content, fields):
+    """Size of a message's content as LXMessage.pack() counts it against
+    the packet limits."""
+    if isinstance(title, str):
+        title = title.encode("utf-8")
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    packed_payload = umsgpack.packb([time.time(), title, content, fields])
+    return (
+        len(packed_payload)
+        - LXMF.LXMessage.TIMESTAMP_SIZE
+        - LXMF.LXMessage.STRUCT_OVERHEAD
+    )
+
+
+def link_is_up(lxm_router, destination_hash):
+    """True if lxm_router has an active link to destination_hash, either
+    one it opened or one the peer opened to us and identified on."""
+    for links in (lxm_router.direct_links, lxm_router.backchannel_links):
+        link = links.get(destination_hash)
+        if link is not None and link.status == RNS.Link.ACTIVE:
+            return True
+    return False
+
+
+def delivery_cost(method, size, link_up):
+    """Number of packets it takes to deliver size bytes of content with
+    method, None if method cannot carry that much."""
+    if method == OPPORTUNISTIC:
+        if size > LXMF.LXMessage.ENCRYPTED_PACKET_MAX_CONTENT:
+            return None
+        return 1
+    if size <= LXMF.LXMessage.LINK_PACKET_MAX_CONTENT:
+        packets = 1
+    else:
+        packets = math.ceil(size / RNS.Resource.SDU) + RESOURCE_OVERHEAD_PACKETS
+    if not link_up:
+        packets += LINK_SETUP_PACKETS
+    return packets
+
+
+def choose_delivery_method(size, link_up):
+    """Returns the cheapest method for size bytes of content. On a tie the
+    link wins, it is already up."""
+    best = DIRECT
+    best_cost = delivery_cost(DIRECT, size, link_up)
+    cost = delivery_cost(OPPORTUNISTIC, size, link_up)
+    if cost is not None and cost < best_cost:
+        best = OPPORTUNISTIC
+    return best
+
+
+class DeliveryLog:
+    """Remembers the delivery method chosen for the last messages and how
+    often each method was chosen."""
+
+    def __init__(self, maxlen=1000):
+        self.entries = collections.deque(maxlen=maxlen)
+        self.counts = collections.Counter()
+
+    def record(self, req_id, size, method, link_up):
+        name = METHOD_NAMES.get(method, method)
+        req_id = format_req_id(req_id)
+        self.entries.append(
+            {
+                "time": time.time(),
+                "req_id": req_id,
+                "size": size,
+                "method": name,
+                "link_up": link_up,
+            }
+        )
+        self.counts[name] += 1
+        print(
+            f"Sending {req_id} ({size} bytes, link {'up' if link_up else 'down'})"
+            f" {name}"
+        )
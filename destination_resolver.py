@@ -0,0 +1,115 @@
+"""Resolves destination hashes to outbound RNS.Destination objects.
+
+Knowing a destination's hash is not enough to send to it, RNS needs the
+identity behind it, which it learns from an announce or a path response.
+DestinationResolver builds each destination once and keeps it. When the
+identity is not known yet, it requests a path once, however many callers
+wait for the same destination, and wakes them from the announce handler as
+soon as the identity arrives.
+"""
+
+import asyncio
+
+import RNS
+
+
+def set_result_once(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+class DestinationResolver:
+    """RNS announce handler and cache of RNS.Destination (OUT, SINGLE)
+    objects for destinations of one aspect, keyed by hash."""
+
+    def __init__(self, app_name="lxmf", *aspects):
+        if not aspects:
+            aspects = ("delivery",)
+        self.app_name = app_name
+        self.aspects = aspects
+        self.aspect_filter = ".".join((app_name,) + aspects)
+        # path responses carry the identity too
+        self.receive_path_responses = True
+        self.destinations = {}  # hash -> RNS.Destination
+        # hash -> [event loop, future, number of callers waiting on it]
+        self.waiters = {}
+
+    def received_announce(self, destination_hash, announced_identity, app_data):
+        # called from a RNS thread
+        waiter = self.waiters.get(destination_hash)
+        if waiter is not None:
+            event_loop, future, _ = waiter
+            event_loop.call_soon_threadsafe(set_result_once, future, announced_identity)
+
+    def get(self, destination_hash):
+        """Returns the destination if its identity is known, None otherwise.
+        Does not wait."""
+        destination = self.destinations.get(destination_hash)
+        if destination is not None:
+            return destination
+        identity = RNS.Identity.recall(destination_hash)
+        if identity is None:
+            return None
+        destination = RNS.Destination(
+            identity,
+            RNS.Destination.OUT,
+            RNS.Destination.SINGLE,
+            self.app_name,
+            *self.aspects,
+        )
+        if destination.hash != destination_hash:
+            # the identity announced a different aspect under this hash
+            return None
+        self.destinations[destination_hash] = destination
+        return destination
+
+    async def wait(self, destination_hash, timeout, arrived):
+        """Requests a path to destination_hash, once however many callers
+        wait for it, and waits up to timeout seconds for its announce or
+        path response, unless arrived() tells it is already here."""
+        waiter = self.waiters.get(destination_hash)
+        if waiter is None:
+            event_loop = asyncio.get_running_loop()
+            waiter = [event_loop, event_loop.create_future(), 0]
+            self.waiters[destination_hash] = waiter
+            RNS.Transport.request_path(destination_hash)
+            print(
+                f"Requested path to {destination_hash.hex()}, waiting for it"
+                f" to arrive for {timeout}s"
+            )
+        waiter[2] += 1
+        try:
+            # the announce may have come in before we registered the waiter
+            if not arrived():
+                await asyncio.wait_for(asyncio.shield(waiter[1]), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiter[2] -= 1
+            if waiter[2] == 0 and self.waiters.get(destination_hash) is waiter:
+                del self.waiters[destination_hash]
+
+    async def resolve(self, destination_hash, timeout):
+        """Returns the destination, requesting a path and waiting up to
+        timeout seconds for its identity if it is not known yet. Returns
+        None if the identity did not arrive in time."""
+        destination = self.get(destination_hash)
+        if destination is None:
+            await self.wait(
+                destination_hash,
+                timeout,
+                lambda: self.get(destination_hash) is not None,
+            )
+            destination = self.get(destination_hash)
+        return destination
+
+    async def find_path(self, destination_hash, timeout):
+        """Returns True once RNS has a path to destination_hash, requesting
+        one and waiting up to timeout seconds if it has none."""
+        if not RNS.Transport.has_path(destination_hash):
+            await self.wait(
+                destination_hash,
+                timeout,
+                lambda: RNS.Transport.has_path(destination_hash),
+            )
+        return RNS.Transport.has_path(destination_hash)
@@ -0,0 +1,172 @@
+import base64
+import hashlib
+import time
+
+import RNS
+import RNS.vendor.umsgpack as umsgpack
+
+from xpub_keysets import compute_keyset_id
+
+# Request header the wallet sends on GET /keys with the keysets it already
+# has, as "id:hash,id:hash". A proxy with a keyset cache strips it and
+# answers with a sync reply instead of the full current keyset.
+KEYSETS_KNOWN_HEADER = "X-Keysets-Known"
+
+# A fingerprint heard in an announce is trusted for this many seconds. The
+# proxy announces again as soon as the fingerprint changes, the limit only
+# matters if we missed that announce.
+FINGERPRINT_MAX_AGE = 60 * 60
+
+
+def keyset_hash(keys):
+    """Short hash of a keyset given as a dict of amount -> hex public key.
+    Unlike the keyset id it does not depend on the id version the mint uses."""
+    h = hashlib.sha256()
+    for amount in sorted(keys, key=int):
+        h.update(f"{int(amount)}:{keys[amount]},".encode())
+    return h.hexdigest()[:16]
+
+
+def encode_known_keysets(known):
+    """Encodes a dict of keyset id -> keyset_hash for the request header."""
+    return ",".join(f"{keyset_id}:{h}" for keyset_id, h in known.items())
+
+
+def decode_known_keysets(header):
+    known = {}
+    for entry in header.split(","):
+        keyset_id, _, h = entry.rpartition(":")
+        if keyset_id:
+            known[keyset_id] = h
+    return known
+
+
+def sync_reply(current_id, active_ids, changed_keys):
+    """Body of a sync reply. changed_keys maps keyset id -> amount -> hex
+    public key for keysets the client does not have or has different
+    versions of, it is left out entirely when nothing changed."""
+    reply = {"current": current_id, "active": active_ids}
+    if changed_keys:
+        reply["keys"] = changed_keys
+    return reply
+
+
+def is_sync_reply(body):
+    return isinstance(body, dict) and "current" in body and "active" in body
+
+
+def compute_keyset_ids(keys):
+    """Returns both the current and the deprecated (pre 0.15) keyset id of a
+    keyset given as a dict of amount -> hex public key."""
+    public_keys = {int(amount): bytes.fromhex(key) for amount, key in keys.items()}
+    concat = "".join(public_keys[amount].hex() for amount in sorted(public_keys))
+    deprecated_id = base64.b64encode(hashlib.sha256(concat.encode()).digest()).decode()
+    return compute_keyset_id(public_keys), deprecated_id[:12]
+
+
+def active_ids_hash(active_ids):
+    """Short hash of a list of keyset ids, independent of their order."""
+    return hashlib.sha256(",".join(sorted(active_ids)).encode()).hexdigest()[:16]
+
+
+def keysets_fingerprint(current_id, active_ids, info_version=None):
+    """Fingerprint of the mint's keysets the proxy puts in its announces:
+    [current keyset id, active_ids_hash of the active keyset ids, version
+    from the mint's /info]."""
+    return [current_id, active_ids_hash(active_ids), info_version]
+
+
+def fingerprint_matches(fingerprint, current_id, active_ids):
+    return (
+        fingerprint is not None
+        and fingerprint[0] == current_id
+        and fingerprint[1] == active_ids_hash(active_ids)
+    )
+
+
+def announce_app_data(app_data, fingerprint, codecs=None):
+    """Appends the fingerprint and the codecs the proxy can decode (see
+    lxmf_codec.capabilities) to LXMF announce app_data. LXMF sends
+    [display_name, stamp_cost] and ignores any further elements, so other
+    LXMF clients still read the announce as before."""
+    peer_data = [None, None]
+    if app_data:
+        peer_data = list(umsgpack.unpackb(app_data))[:2]
+    return umsgpack.packb(peer_data + [fingerprint, codecs])
+
+
+def _peer_data(app_data):
+    if not app_data:
+        return None
+    try:
+        peer_data = umsgpack.unpackb(app_data)
+    except Exception:
+        return None
+    if not isinstance(peer_data, list):
+        return None
+    return peer_data
+
+
+def fingerprint_from_app_data(app_data):
+    """Returns the fingerprint of an announce made with announce_app_data,
+    or None for announces without one."""
+    peer_data = _peer_data(app_data)
+    if peer_data is None or len(peer_data) < 3:
+        return None
+    fingerprint = peer_data[2]
+    if not isinstance(fingerprint, list) or len(fingerprint) != 3:
+        return None
+    return fingerprint
+
+
+def codecs_from_app_data(app_data):
+    """Returns the codecs of an announce made with announce_app_data, or
+    None for announces without them."""
+    peer_data = _peer_data(app_data)
+    if peer_data is None or len(peer_data) < 4:
+        return None
+    codecs = peer_data[3]
+    if not isinstance(codecs, list) or not all(isinstance(c, int) for c in codecs):
+        return None
+    return codecs
+
+
+class AnnouncedFingerprints:
+    """RNS announce handler that remembers the latest keyset fingerprint
+    each LXMF destination announced, with the time we heard it, and the
+    codecs it announced."""
+
+    def __init__(self):
+        self.aspect_filter = "lxmf.delivery"
+        # path responses carry the same app_data, take them too
+        self.receive_path_responses = True
+        self.fingerprints = {}  # destination hex -> (fingerprint, time)
+        self.codecs = {}  # destination hex -> codecs
+
+    def received_announce(self, destination_hash, announced_identity, app_data):
+        fingerprint = fingerprint_from_app_data(app_data)
+        if fingerprint is not None:
+            self.fingerprints[destination_hash.hex()] = (fingerprint, time.time())
+        codecs = codecs_from_app_data(app_data)
+        if codecs is not None:
+            self.codecs[destination_hash.hex()] = codecs
+
+    def get(self, destination, max_age=FINGERPRINT_MAX_AGE):
+        """Returns the fingerprint destination announced in the last max_age
+        seconds, or None."""
+        fingerprint, heard_at = self.fingerprints.get(destination, (None, 0))
+        if time.time() - heard_at > max_age:
+            return None
+        return fingerprint
+
+    def codecs_of(self, destination):
+        """Returns the codecs destination announced, also in an announce RNS
+        stored before we started, or None."""
+        codecs = self.codecs.get(destination)
+        if codecs is None:
+            codecs = codecs_from_app_data(
+                RNS.Identity.recall_app_data(bytes.fromhex(destination))
+            )
+            if codecs is not None:
+                self.codecs[destination] = codecs
+        return codecs
@@ -0,0 +1,342 @@
+import json
+import os
+import pathlib
+import struct
+import zlib
+
+import RNS.vendor.umsgpack as umsgpack
+
+import cashu_packing
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Version of the envelope layout. Bump it whenever the header or the
+# structure of the packed request / response changes.
+WIRE_VERSION = 0x01
+
+CODEC_NONE = 0x00
+CODEC_ZLIB = 0x01
+CODEC_ZSTD = 0x02
+# zstd with a pre-trained dictionary, the header carries the dictionary id
+# as a 4 byte big endian integer right after the codec byte
+CODEC_ZSTD_DICT = 0x03
+
+# Body schemas and protocol features are advertised in the same list as codecs
+SCHEMA_CASHU = 0x10
+# several requests in one envelope, see encode_batch_request
+FEATURE_BATCH = 0x20
+
+# LXMF field names used by the envelope. "codecs" is sent by both sides
+# on every message, it is how a peer learns that the other end speaks the
+# envelope format and which compressions and schemas it can decode.
+FIELD_ENVELOPE = "env"
+FIELD_CODECS = "codecs"
+# ids of the zstd dictionaries the sender has, only sent if it has any
+FIELD_DICTIONARIES = "dicts"
+# HTTP status of a reply sent without the envelope, left out for 200
+FIELD_STATUS = "status"
+
+DICTIONARY_DIR = pathlib.Path(__file__).with_name("dictionaries")
+DICTIONARY_SUFFIX = ".zdict"
+
+_dictionaries = None
+
+
+def load_dictionaries(path=DICTIONARY_DIR):
+    """Loads all zstd dictionaries (*.zdict) from path, replacing the ones
+    loaded before. Several versions can be loaded at once, they are told
+    apart by the dictionary id stored inside each of them."""
+    global _dictionaries
+    _dictionaries = {}
+    if zstandard is None or not os.path.isdir(path):
+        return _dictionaries
+    for filename in sorted(os.listdir(path)):
+        if not filename.endswith(DICTIONARY_SUFFIX):
+            continue
+        with open(os.path.join(path, filename), "rb") as f:
+            dictionary = zstandard.ZstdCompressionDict(f.read())
+        _dictionaries[dictionary.dict_id()] = dictionary
+    return _dictionaries
+
+
+def dictionaries():
+    """Returns the loaded dictionaries keyed by id, loads them on first use."""
+    if _dictionaries is None:
+        load_dictionaries()
+    return _dictionaries
+
+
+def dictionary_ids():
+    return sorted(dictionaries().keys())
+
+
+def supported_codecs():
+    """Returns the codecs this side can decode, most preferred first."""
+    codecs = []
+    if zstandard is not None:
+        codecs.append(CODEC_ZSTD)
+    codecs.append(CODEC_ZLIB)
+    codecs.append(CODEC_NONE)
+    return codecs
+
+
+def capabilities():
+    """Returns everything we advertise in the codecs field."""
+    return supported_codecs() + [SCHEMA_CASHU, FEATURE_BATCH]
+
+
+def choose_codec(offered):
+    """Picks the best codec that both we and the peer (offered) support.
+    Returns None if the peer did not offer anything we understand."""
+    if not offered:
+        return None
+    for codec in supported_codecs():
+        if codec in offered:
+            return codec
+    return None
+
+
+def choose_schema(offered):
+    """Returns SCHEMA_CASHU if the peer can unpack cashu bodies."""
+    if offered and SCHEMA_CASHU in offered:
+        return SCHEMA_CASHU
+    return None
+
+
+def choose_dictionary(offered):
+    """Picks the newest (highest id) dictionary both sides have."""
+    if not offered:
+        return None
+    common = [i for i in offered if i in dictionaries()]
+    if not common:
+        return None
+    return max(common)
+
+
+def _compress(codec, data, dictionary_id=None):
+    if codec == CODEC_ZSTD_DICT:
+        return zstandard.ZstdCompressor(
+            level=19, dict_data=dictionaries()[dictionary_id]
+        ).compress(data)
+    elif codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=19).compress(data)
+    elif codec == CODEC_ZLIB:
+        return zlib.compress(data, 9)
+    return data
+
+
+def _decompress(codec, data, dictionary_id=None):
+    if codec == CODEC_ZSTD_DICT:
+        if dictionary_id not in dictionaries():
+            raise ValueError(
+                f"Received envelope with unknown dictionary {dictionary_id}"
+            )
+        return zstandard.ZstdDecompressor(
+            dict_data=dictionaries()[dictionary_id]
+        ).decompress(data)
+    elif codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Received zstd envelope, but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    elif codec == CODEC_NONE:
+        return data
+    raise ValueError(f"Unknown envelope codec {codec}")
+
+
+def pack_envelope(obj, codec=CODEC_NONE, dictionary_id=None):
+    """Packs obj with msgpack and compresses it with codec, or with the zstd
+    dictionary dictionary_id if given. The smallest result wins, small
+    payloads often grow when compressed without a dictionary, in that case
+    they are sent uncompressed and the header says so."""
+    packed = umsgpack.packb(obj)
+    best = bytes([WIRE_VERSION, CODEC_NONE]) + packed
+    if codec != CODEC_NONE:
+        compressed = bytes([WIRE_VERSION, codec]) + _compress(codec, packed)
+        if len(compressed) < len(best):
+            best = compressed
+    if dictionary_id is not None and dictionary_id in dictionaries():
+        compressed = (
+            bytes([WIRE_VERSION, CODEC_ZSTD_DICT])
+            + struct.pack(">I", dictionary_id)
+            + _compress(CODEC_ZSTD_DICT, packed, dictionary_id)
+        )
+        if len(compressed) < len(best):
+            best = compressed
+    return best
+
+
+def unpack_envelope(envelope):
+    if len(envelope) < 2:
+        raise ValueError("Envelope too short")
+    version, codec = envelope[0], envelope[1]
+    if version != WIRE_VERSION:
+        raise ValueError(f"Unsupported envelope version {version}")
+    if codec == CODEC_ZSTD_DICT:
+        if len(envelope) < 6:
+            raise ValueError("Envelope too short")
+        (dictionary_id,) = struct.unpack(">I", envelope[2:6])
+        return umsgpack.unpackb(_decompress(codec, envelope[6:], dictionary_id))
+    return umsgpack.unpackb(_decompress(codec, envelope[2:]))
+
+
+def request_payload(
+    method,
+    path,
+    params=None,
+    headers=None,
+    cookies=None,
+    data=None,
+    json=None,
+    schema=None,
+):
+    """Builds the object that encode_request packs into the envelope. Short
+    keys are used on purpose, every byte counts on a radio link. With
+    SCHEMA_CASHU the json body is packed with cashu_packing."""
+    request = {"m": method, "u": path}
+    if params is not None:
+        request["p"] = params
+    if headers is not None:
+        request["h"] = headers
+    if cookies is not None:
+        request["c"] = cookies
+    if data is not None:
+        request["d"] = data
+    if json is not None:
+        if schema == SCHEMA_CASHU:
+            request["k"] = cashu_packing.pack(json)
+        else:
+            request["j"] = json
+    return request
+
+
+def encode_request(method, path, codec, dictionary_id=None, **kwargs):
+    """Encodes a HTTP request into an envelope, kwargs are the optional
+    arguments of request_payload."""
+    return pack_envelope(request_payload(method, path, **kwargs), codec, dictionary_id)
+
+
+def encode_batch_request(requests, codec, dictionary_id=None, schema=None):
+    """Encodes several HTTP requests into one envelope. requests is a list
+    of dicts with the arguments of request_payload (method, path, params,
+    ...). They are compressed together, so similar requests cost little."""
+    return pack_envelope(
+        {"B": [request_payload(schema=schema, **request) for request in requests]},
+        codec,
+        dictionary_id,
+    )
+
+
+def _request_from_payload(request):
+    if "k" in request:
+        request["j"] = cashu_packing.unpack(request["k"])
+    return {
+        "method": request.get("m"),
+        "path": request.get("u", ""),
+        "params": request.get("p"),
+        "headers": request.get("h"),
+        "cookies": request.get("c"),
+        "data": request.get("d"),
+        "json": request.get("j"),
+    }
+
+
+def decode_request(envelope):
+    """Decodes an envelope produced by encode_request into a dict with the
+    same keys the legacy LXMF fields use."""
+    return _request_from_payload(unpack_envelope(envelope))
+
+
+def decode_requests(envelope):
+    """Decodes an envelope produced by encode_request or
+    encode_batch_request. Returns a tuple of (list of requests as returned
+    by decode_request, is_batch)."""
+    payload = unpack_envelope(envelope)
+    if "B" in payload:
+        return ([_request_from_payload(request) for request in payload["B"]], True)
+    return ([_request_from_payload(payload)], False)
+
+
+def response_payload(status_code, text, schema=None, headers=None):
+    """Builds the object that encode_response packs into the envelope. JSON
+    bodies are stored as msgpack objects (packed with cashu_packing for
+    SCHEMA_CASHU), anything else is stored as a string. headers is a dict
+    of the response headers worth passing on, if any."""
+    try:
+        body = json.loads(text)
+        is_json = True
+    except ValueError:
+        body = text
+        is_json = False
+    response = {"s": status_code}
+    if not is_json:
+        response["b"] = body
+        response["t"] = True
+    elif schema == SCHEMA_CASHU:
+        response["k"] = cashu_packing.pack(body)
+    else:
+        response["b"] = body
+    if headers:
+        response["h"] = headers
+    return response
+
+
+def encode_response(
+    status_code, text, codec, schema=None, dictionary_id=None, headers=None
+):
+    """Encodes a HTTP response into an envelope."""
+    return pack_envelope(
+        response_payload(status_code, text, schema, headers), codec, dictionary_id
+    )
+
+
+def encode_batch_response(replies, codec, schema=None, dictionary_id=None):
+    """Encodes the replies to a batch of requests into one envelope. replies
+    is a list of (status_code, text, headers) in the order of the requests,
+    None for requests that got no reply."""
+    return pack_envelope(
+        {
+            "B": [
+                (
+                    None
+                    if reply is None
+                    else response_payload(reply[0], reply[1], schema, reply[2])
+                )
+                for reply in replies
+            ]
+        },
+        codec,
+        dictionary_id,
+    )
+
+
+def _response_from_payload(response):
+    if "k" in response:
+        response["b"] = cashu_packing.unpack(response["k"])
+    return (
+        response.get("s", 200),
+        response.get("b"),
+        not response.get("t", False),
+        response.get("h", {}),
+    )
+
+
+def decode_response(envelope):
+    """Decodes an envelope produced by encode_response. Returns a tuple of
+    (status_code, body, is_json, headers)."""
+    return _response_from_payload(unpack_envelope(envelope))
+
+
+def decode_batch_response(envelope):
+    """Decodes an envelope produced by encode_batch_response. Returns a
+    list with a (status_code, body, is_json, headers) tuple or None per
+    request."""
+    return [
+        None if response is None else _response_from_payload(response)
+        for response in unpack_envelope(envelope)["B"]
+    ]
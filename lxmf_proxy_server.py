@@ -1,85 +1,786 @@
+import argparse
 import asyncio
+import collections
+import itertools
+import json
+import math
+import re
 import RNS
+import RNS.vendor.umsgpack as umsgpack
 import os
 import time
 import LXMF
-import sys
 import httpx
 
+from lxmf_codec import (
+    FIELD_CODECS,
+    FIELD_DICTIONARIES,
+    FIELD_ENVELOPE,
+    FIELD_STATUS,
+    CODEC_NONE,
+    SCHEMA_CASHU,
+    capabilities,
+    choose_codec,
+    choose_dictionary,
+    choose_schema,
+    decode_requests,
+    dictionary_ids,
+    encode_batch_response,
+    encode_response,
+    request_payload,
+    response_payload,
+)
+from keyset_sync import (
+    KEYSETS_KNOWN_HEADER,
+    announce_app_data,
+    compute_keyset_ids,
+    decode_known_keysets,
+    keyset_hash,
+    keysets_fingerprint,
+    sync_reply,
+)
+from delivery_method import (
+    SESSION,
+    DeliveryLog,
+    choose_delivery_method,
+    content_size,
+    link_is_up,
+)
+from lxmf_session import receive_fields, send_fields, session_destination
+from request_tracking import format_req_id
+from destination_resolver import DestinationResolver
+from url_routing import is_read_only
+from xpub_keysets import (
+    KEYS_FORMAT_HEADER,
+    KEYS_FORMAT_XPUB,
+    compute_keyset_id,
+    derive_public_keys,
+    xpub_keys_reply,
+)
 
-class LXMFWrapperProxy:
+KEYS_PATH = re.compile(r"^/keys(/[^/]+)?$")
+# Number of denominations of a cashu keyset
+MAX_ORDER = 64
+# Headers of the mint's error replies that are passed on to the wallet
+FORWARDED_HEADERS = ("content-type", "retry-after")
+# Requests that change the mint's state are served first, then the ones
+# that check something, then plain reads. A batch has the priority of its
+# most important request.
+PRIORITY_STATE = 0
+PRIORITY_CHECK = 1
+PRIORITY_READ = 2
+ROUTE_PRIORITIES = {
+    "/mint": PRIORITY_STATE,
+    "/split": PRIORITY_STATE,
+    "/melt": PRIORITY_STATE,
+    "/check": PRIORITY_CHECK,
+    "/checkfees": PRIORITY_CHECK,
+    "/restore": PRIORITY_CHECK,
+}
+# Seconds the mint's replies to these GET requests are served from the
+# response cache, the first path that matches counts. Keys of a keyset id
+# never change.
+RESPONSE_TTLS = (
+    (re.compile(r"^/keys/[^/]+$"), 60 * 60),
+    (re.compile(r"^/keys$"), 60),
+    (re.compile(r"^/keysets$"), 60),
+    (re.compile(r"^/info$"), 5 * 60),
+)
+# How long to wait for the identity of a client we have not heard from,
+# it normally announces before its first request
+IDENTITY_TIMEOUT = 30
 
-    async def receive_handler_async(self, lxm):
-        fields = lxm.fields
-        req_id = fields.pop("req_id", None)
-        if req_id is None:
-            print("Warning: Received request without req_id, ignoring")
-            return None
 
-        if "method" not in lxm.fields:
-            print("Warning: Received request without method, ignoring")
-            return None
+class TrafficRecorder:
+    """Stores the uncompressed envelope payloads of requests and replies,
+    one file per message. train_dictionary.py learns a zstd dictionary
+    from these samples."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.counter = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def record(self, kind, payload):
+        self.counter += 1
+        filename = f"{time.time_ns()}-{self.counter}-{kind}.msgpack"
+        try:
+            with open(os.path.join(self.directory, filename), "wb") as f:
+                f.write(umsgpack.packb(payload))
+        except OSError as e:
+            print(f"Warning: Could not record traffic sample: {e}")
+
+
+class MintKeysetCache:
+    """Keeps the mint's current keyset, its active keyset ids and the keys
+    of each active keyset, so wallets can check their cached keysets
+    against it without downloading them. The current keyset and the
+    active ids are refetched after ttl seconds, keys of a keyset id never
+    change and are kept. fetch(path) returns the mint's reply to a GET of
+    path, it goes through the proxy's response cache."""
+
+    def __init__(self, fetch, ttl=60):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.fetched_at = 0
+        self.current_id = None
+        self.active_ids = []
+        self.keys = {}  # keyset id -> amount -> hex public key
+        self.lock = asyncio.Lock()
 
-        method = lxm.fields["method"]
-        if method != "GET" and method != "POST":
+    async def get_json(self, path):
+        resp = await self.fetch(path)
+        return resp.json()
+
+    async def refresh(self):
+        async with self.lock:
+            if time.time() - self.fetched_at < self.ttl:
+                return
+            current_keys = await self.get_json("/keys")
+            active_ids = (await self.get_json("/keysets"))["keysets"]
+            # The mint may list the current keyset under its new or its
+            # deprecated id, use whichever it lists
+            current_id, deprecated_id = compute_keyset_ids(current_keys)
+            if deprecated_id in active_ids and current_id not in active_ids:
+                current_id = deprecated_id
+            self.keys[current_id] = current_keys
+            for keyset_id in active_ids:
+                if keyset_id not in self.keys:
+                    keyset_id_urlsafe = keyset_id.replace("+", "-").replace("/", "_")
+                    self.keys[keyset_id] = await self.get_json(
+                        f"/keys/{keyset_id_urlsafe}"
+                    )
+            self.current_id = current_id
+            self.active_ids = active_ids
+            self.fetched_at = time.time()
+
+    async def sync_reply(self, known):
+        """Builds the reply to a wallet that has the keysets in known (a dict
+        of keyset id -> keyset_hash): only keysets it is missing or has a
+        different version of are included."""
+        await self.refresh()
+        changed = {}
+        for keyset_id in set(self.active_ids) | {self.current_id}:
+            keys = self.keys[keyset_id]
+            if known.get(keyset_id) != keyset_hash(keys):
+                changed[keyset_id] = keys
+        return sync_reply(self.current_id, self.active_ids, changed)
+
+    async def fingerprint(self):
+        """Fingerprint of the mint's keysets and info version that we put
+        in our announces."""
+        await self.refresh()
+        info_version = None
+        try:
+            info_version = (await self.get_json("/info")).get("version")
+        except (httpx.HTTPStatusError, httpx.RequestError, ValueError) as exc:
+            print(f"Could not get mint info for the announce: {exc}")
+        return keysets_fingerprint(self.current_id, self.active_ids, info_version)
+
+
+async def run_shared(future, run):
+    """Awaits run() and settles future, which other callers may be waiting
+    on, with its result or exception. If run() is cancelled, so is future,
+    the waiters must not hang."""
+    try:
+        result = await run()
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        # mark the exception retrieved, there may be no other waiter
+        future.exception()
+        raise
+    future.set_result(result)
+    return result
+
+
+class ReplyCache:
+    """Replies to recent requests, keyed by (source hash, req_id). A client
+    that retransmits a request gets the same reply again and the mint sees
+    the request only once, which matters for /split and /melt: running
+    them twice fails because the secrets are already spent. A
+    retransmission that arrives while the request is still running waits
+    for it. Entries are dropped after ttl seconds, or oldest first when
+    there are more than max_entries."""
+
+    def __init__(self, max_entries=1000, ttl=10 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> (expires_at, future)
+        self.hits = 0
+        self.misses = 0
+
+    def expire(self):
+        now = time.time()
+        while self.entries:
+            key, (expires_at, _) = next(iter(self.entries.items()))
+            if expires_at > now and len(self.entries) <= self.max_entries:
+                break
+            del self.entries[key]
+
+    def __contains__(self, key):
+        self.expire()
+        return key in self.entries
+
+    async def get_or_run(self, key, run):
+        """Returns the reply stored for key, or awaits run() and stores what
+        it returns."""
+        self.expire()
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
             print(
-                f"Warning: Received request with unsupported method {method}, ignoring"
+                f"Request {format_req_id(key[1])} is a retransmission, replying from cache"
             )
+            return await asyncio.shield(entry[1])
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.entries[key] = (time.time() + self.ttl, future)
+        self.expire()
+        try:
+            return await run_shared(future, run)
+        except BaseException:
+            # let a retransmission try again
+            self.entries.pop(key, None)
+            raise
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class RequestCoalescer:
+    """Runs requests with the same key once at a time, only for requests
+    that do not change anything (see url_routing.is_read_only). A request that comes
+    while one with its key is in flight does not run, it gets the result
+    (or exception) of the one in flight. When a mint gets a new keyset,
+    many wallets ask for /keys at once, and the mint sees one request."""
+
+    def __init__(self):
+        self.in_flight = {}  # key -> future
+        self.runs = 0
+        self.coalesced = 0
+
+    async def run(self, key, run):
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        self.runs += 1
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            return await run_shared(future, run)
+        finally:
+            del self.in_flight[key]
+
+    def stats(self):
+        return {
+            "in_flight": len(self.in_flight),
+            "runs": self.runs,
+            "coalesced": self.coalesced,
+        }
+
+
+class ResponseCache:
+    """The mint's successful replies to GET requests of RESPONSE_TTLS paths,
+    keyed like RequestCoalescer. A reply is fresh for its path's ttl. After
+    that, for max_stale more seconds, the old reply is served right away
+    while it is fetched again in the background. An older reply is fetched
+    again before replying, but served anyway if the mint cannot be reached
+    or fails, so wallets can load the mint while it restarts. At most
+    max_entries replies are kept, the least recently used are dropped
+    first. invalidate() drops them all, when the mint's keysets change."""
+
+    def __init__(self, max_entries=256, max_stale=10 * 60):
+        self.max_entries = max_entries
+        self.max_stale = max_stale
+        self.entries = collections.OrderedDict()  # key -> (fetched_at, resp)
+        self.revalidating = {}  # key -> task
+        # replies fetched before an invalidate() are not stored
+        self.generation = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def ttl_for(path):
+        for pattern, ttl in RESPONSE_TTLS:
+            if pattern.match(path):
+                return ttl
+        return None
+
+    def store(self, key, resp, generation):
+        if generation != self.generation or resp.status_code != 200:
+            return
+        self.entries[key] = (time.time(), resp)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def fetch(self, key, fetch):
+        generation = self.generation
+        resp = await fetch()
+        self.store(key, resp, generation)
+        return resp
+
+    async def revalidate(self, key, fetch):
+        try:
+            await self.fetch(key, fetch)
+        except (httpx.HTTPStatusError, httpx.RequestError) as exc:
+            print(f"Could not revalidate cached reply of the mint: {exc}")
+        finally:
+            del self.revalidating[key]
+
+    async def get(self, key, path, fetch, allow_stale=True):
+        """Returns the mint's reply (an httpx.Response) to the GET request
+        of path, from the cache or by awaiting fetch(), which raises
+        httpx.HTTPStatusError for error replies. Without allow_stale, a
+        reply older than its ttl is fetched again before returning, unless
+        the mint fails."""
+        ttl = self.ttl_for(path)
+        if ttl is None:
+            return await fetch()
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return await self.fetch(key, fetch)
+        self.entries.move_to_end(key)
+        fetched_at, resp = entry
+        age = time.time() - fetched_at
+        if age < ttl:
+            self.hits += 1
+            return resp
+        if allow_stale and age < ttl + self.max_stale:
+            self.stale_hits += 1
+            if key not in self.revalidating:
+                self.revalidating[key] = asyncio.create_task(
+                    self.revalidate(key, fetch)
+                )
+            return resp
+        self.misses += 1
+        try:
+            return await self.fetch(key, fetch)
+        except httpx.HTTPStatusError as exc:
+            if exc.response.status_code < 500:
+                raise
+            print(f"The mint failed, serving a reply from {age:.0f}s ago: {exc}")
+        except httpx.RequestError as exc:
+            print(f"Mint unreachable, serving a reply from {age:.0f}s ago: {exc}")
+        self.stale_hits += 1
+        return resp
+
+    def invalidate(self):
+        self.generation += 1
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+        }
+
+
+class ClientIdentityCache:
+    """Public keys of the clients that sent us requests, keyed by their LXMF
+    destination hash, the most recently seen last, saved to path. A client
+    we know gets its reply without waiting for a path request, also after
+    the proxy restarted or RNS forgot about the client. Holds at most
+    max_entries clients, the least recently seen are dropped first."""
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.identities = collections.OrderedDict()  # hash -> public key
+        self.dirty = False
+        # was the identity of the source of a request known right away, and
+        # how long did we wait for it
+        self.hits = 0
+        self.misses = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                entries = umsgpack.unpackb(f.read())
+        except Exception as e:
+            print(f"Warning: Could not load client identities from {self.path}: {e}")
+            return
+        for destination_hash, public_key in entries[-self.max_entries :]:
+            self.identities[destination_hash] = public_key
+        print(f"Loaded {len(self.identities)} client identities")
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(
+                    umsgpack.packb([list(entry) for entry in self.identities.items()])
+                )
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            # stays dirty, the next save tries again
+            print(f"Warning: Could not save client identities to {self.path}: {e}")
+            return
+        self.dirty = False
+
+    def learn(self, destination_hash, identity):
+        public_key = identity.get_public_key()
+        if self.identities.get(destination_hash) != public_key:
+            self.identities[destination_hash] = public_key
+            self.dirty = True
+        self.identities.move_to_end(destination_hash)
+        while len(self.identities) > self.max_entries:
+            self.identities.popitem(last=False)
+
+    def remember(self, destination_hash):
+        """Makes sure RNS can recall destination_hash if we know it.
+        Returns True if we do."""
+        public_key = self.identities.get(destination_hash)
+        if public_key is None:
+            return False
+        if RNS.Identity.recall(destination_hash) is None:
+            RNS.Identity.remember(None, destination_hash, public_key)
+        self.identities.move_to_end(destination_hash)
+        return True
+
+    def record_recall(self, known, wait):
+        if known:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def stats(self):
+        recalls = self.hits + self.misses
+        return {
+            "entries": len(self.identities),
+            "hits": self.hits,
+            "misses": self.misses,
+            "wait_avg": round(self.wait_total / recalls, 3) if recalls else 0.0,
+            "wait_max": round(self.wait_max, 3),
+        }
+
+
+def request_priority(requests):
+    return min(
+        ROUTE_PRIORITIES.get(request["path"].split("?")[0], PRIORITY_READ)
+        for request in requests
+    )
+
+
+class ProxyBusy(Exception):
+    """Raised by WorkerPool.run when the queue is full. The client is told
+    to try again in retry_after seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Proxy is busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class WorkerPool:
+    """Runs the requests that go to the mint on a fixed number of workers.
+    Requests wait in a priority queue (see ROUTE_PRIORITIES), in order of
+    arrival within a priority. Every request of a batch takes a worker of
+    its own. When max_queue requests are waiting, or half of that for plain
+    reads, new ones are rejected with ProxyBusy instead of waiting longer
+    and longer."""
+
+    def __init__(self, workers=8, max_queue=64):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue = None
+        self.tasks = []
+        self.order = itertools.count()
+        # smoothed seconds a request keeps a worker busy
+        self.service_time = 1.0
+        self.completed = 0
+        self.rejected = 0
+
+    def start(self):
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def worker(self):
+        while True:
+            _, _, run, future = await self.queue.get()
+            if future.done():
+                # the request was cancelled while it waited
+                continue
+            started = time.time()
+            # in a task of its own, so the worker survives it being cancelled
+            task = asyncio.ensure_future(run())
+            try:
+                await asyncio.wait([task])
+            except asyncio.CancelledError:
+                task.cancel()
+                future.cancel()
+                raise
+            if not future.done():
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(task.result())
+            self.completed += 1
+            self.service_time += 0.2 * (time.time() - started - self.service_time)
+
+    def queue_limit(self, priority):
+        if priority >= PRIORITY_READ:
+            return self.max_queue // 2
+        return self.max_queue
+
+    def retry_after(self):
+        """Seconds until the requests in the queue are probably served."""
+        return max(1, math.ceil(self.queue.qsize() * self.service_time / self.workers))
+
+    async def run(self, priority, runs):
+        """Awaits each of runs (a list of functions returning awaitables) on
+        a worker and returns a list of what they return, like
+        asyncio.gather. Raises ProxyBusy if the queue is full, then none of
+        them run."""
+        if self.queue is None:
+            self.start()
+        if self.queue.qsize() >= self.queue_limit(priority):
+            self.rejected += 1
+            raise ProxyBusy(self.retry_after())
+        futures = []
+        for run in runs:
+            future = asyncio.get_running_loop().create_future()
+            self.queue.put_nowait((priority, next(self.order), run, future))
+            futures.append(future)
+        return await asyncio.gather(*futures)
+
+    def stats(self):
+        return {
+            "queued": 0 if self.queue is None else self.queue.qsize(),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "service_time": round(self.service_time, 3),
+        }
+
+
+class TokenBucket:
+    """Holds up to burst tokens and gains rate tokens per second. The level
+    can go below zero, a client in debt has to wait until it is paid off."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.level = burst
+        self.updated = time.time()
+
+    def refill(self, now):
+        self.level = min(self.burst, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until the level is at least amount."""
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+class RateLimiter:
+    """Token buckets per client: one for messages, one for bytes of
+    replies. A request takes a message token and is refused while there is
+    none or the client owes bytes, the bytes of its reply are charged when
+    it is sent. A rate of 0 means no limit. Buckets of the max_clients most
+    recently seen clients are kept."""
+
+    def __init__(
+        self,
+        messages_per_minute=60,
+        message_burst=20,
+        bytes_per_minute=1000000,
+        byte_burst=250000,
+        max_clients=10000,
+    ):
+        self.messages_per_minute = messages_per_minute
+        self.message_burst = message_burst
+        self.bytes_per_minute = bytes_per_minute
+        self.byte_burst = byte_burst
+        self.max_clients = max_clients
+        # source hash -> (message bucket, byte bucket), either may be None
+        self.buckets = collections.OrderedDict()
+        self.admitted = 0
+        self.throttled = 0
+
+    def buckets_of(self, source_hash):
+        buckets = self.buckets.get(source_hash)
+        if buckets is None:
+            buckets = (
+                self._bucket(self.messages_per_minute, self.message_burst),
+                self._bucket(self.bytes_per_minute, self.byte_burst),
+            )
+            self.buckets[source_hash] = buckets
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        self.buckets.move_to_end(source_hash)
+        now = time.time()
+        for bucket in buckets:
+            if bucket is not None:
+                bucket.refill(now)
+        return buckets
+
+    @staticmethod
+    def _bucket(per_minute, burst):
+        if not per_minute:
             return None
+        return TokenBucket(per_minute / 60, burst)
 
-        print(f"Got a request with ID {req_id} for method {method}")
-
-        destination_bytes = lxm.source_hash
-        destination_identity = RNS.Identity.recall(destination_bytes)
-        # If we don't know the identity yet:
-        if destination_identity is None:
-            basetime = time.time()
-            # Request it
-            RNS.Transport.request_path(destination_bytes)
-            # And wait until it arrives; timeout in 30s
-            while destination_identity is None and (time.time() - basetime) < 30:
-                destination_identity = RNS.Identity.recall(destination_bytes)
-                await asyncio.sleep(1)
-        if destination_identity is None:
-            print("Error: Cannot recall identity")
+    def admit(self, source_hash):
+        """Takes a message token of source_hash. Returns None if the request
+        may go on, otherwise the seconds until the client may try again."""
+        messages, replies = self.buckets_of(source_hash)
+        wait = 0.0
+        if messages is not None:
+            wait = messages.wait_time(1)
+        if replies is not None:
+            wait = max(wait, replies.wait_time(0))
+        if wait > 0:
+            self.throttled += 1
+            return wait
+        if messages is not None:
+            messages.level -= 1
+        self.admitted += 1
+        return None
+
+    def charge(self, source_hash, size):
+        """Charges size bytes of a reply to source_hash."""
+        _, replies = self.buckets_of(source_hash)
+        if replies is not None:
+            replies.level -= size
+
+    def levels(self, below_burst=False):
+        """Current bucket levels by client (hex): messages and bytes left,
+        None for a budget that is not limited. With below_burst, only of
+        clients that used some of their budget."""
+        now = time.time()
+        levels = {}
+        for source_hash, buckets in self.buckets.items():
+            current = []
+            full = True
+            for bucket in buckets:
+                if bucket is None:
+                    current.append(None)
+                else:
+                    bucket.refill(now)
+                    current.append(round(bucket.level, 1))
+                    full = full and bucket.level >= bucket.burst
+            if below_burst and full:
+                continue
+            levels[source_hash.hex()] = {"messages": current[0], "bytes": current[1]}
+        return levels
+
+    def stats(self):
+        return {
+            "clients": len(self.buckets),
+            "admitted": self.admitted,
+            "throttled": self.throttled,
+        }
+
+
+class LXMFWrapperProxy:
+
+    def xpub_reply_for_keys(self, text):
+        """If the keyset the mint returned (text) can be derived from one of
+        the configured xpubs, returns the much smaller xpub reply body,
+        otherwise None and the full keyset is sent."""
+        try:
+            keys = json.loads(text)
+            amounts = sorted(int(amount) for amount in keys)
+        except (ValueError, TypeError, AttributeError):
             return None
+        count = len(keys)
+        if amounts != [2**i for i in range(count)]:
+            return None
+        for xpub, derived in self.keyset_xpubs.items():
+            if count > len(derived):
+                continue
+            if all(derived[amount].hex() == keys[str(amount)] for amount in amounts):
+                public_keys = {amount: derived[amount] for amount in amounts}
+                return xpub_keys_reply(xpub, count, compute_keyset_id(public_keys))
+        return None
+
+    async def get_from_mint(
+        self, path, params=None, headers=None, cookies=None, allow_stale=True
+    ):
+        """GET of path from the mint, raises httpx.HTTPStatusError for error
+        replies. Read-only requests are answered from the response cache
+        or share the same GET in flight, see ResponseCache.get() for
+        allow_stale."""
+        url = self.destination_url + path
+
+        async def get():
+            resp = await self.httpx.get(
+                url, params=params, headers=headers, cookies=cookies
+            )
+            resp.raise_for_status()
+            return resp
 
-        # Create the destination
-        lxmf_destination = RNS.Destination(
-            destination_identity,
-            RNS.Destination.OUT,
-            RNS.Destination.SINGLE,
-            "lxmf",
-            "delivery",
+        if not is_read_only(path):
+            # like GET /mint, which creates a new invoice every time
+            return await get()
+        key = json.dumps(
+            [url, params or None, headers or None, cookies or None],
+            sort_keys=True,
+            default=str,
+        )
+        return await self.response_cache.get(
+            key, path, lambda: self.get_coalescer.run(key, get), allow_stale
         )
 
-        # Let's create the HTTP request
-        url = self.destination_url + lxm.content_as_string()
-        params = None
-        headers = None
-        cookies = None
-        data = None
-        json = None
+    async def handle_http_request(self, request):
+        """Runs the decoded request against the mint, or answers it from our
+        own caches for the protocol extensions. Returns (status_code, text,
+        headers) of the reply, or None if there is nothing to reply with.
+        headers are the FORWARDED_HEADERS of an error reply, None otherwise."""
+        method = request["method"]
+        url = self.destination_url + request["path"]
+        params = request["params"]
+        headers = request["headers"]
+        cookies = request["cookies"]
+        data = request["data"]
+        json_body = request["json"]
 
-        print(f"Crafting http request to {url}")
+        # The wallet can derive keys from an xpub and sync keysets it has
+        # cached. These are our extensions of the protocol, so the headers
+        # are not forwarded to the mint.
+        wants_xpub = False
+        known_keysets = None
+        if headers is not None:
+            wants_xpub = headers.pop(KEYS_FORMAT_HEADER, None) == KEYS_FORMAT_XPUB
+            known_keysets = headers.pop(KEYSETS_KNOWN_HEADER, None)
 
-        if "params" in lxm.fields:
-            params = lxm.fields["params"]
-        if "headers" in lxm.fields:
-            headers = lxm.fields["headers"]
-        if "cookies" in lxm.fields:
-            cookies = lxm.fields["cookies"]
-        if "data" in lxm.fields:
-            data = lxm.fields["data"]
-        if "json" in lxm.fields:
-            json = lxm.fields["json"]
+        if known_keysets is not None and method == "GET" and request["path"] == "/keys":
+            try:
+                reply = await self.keyset_cache.sync_reply(
+                    decode_known_keysets(known_keysets)
+                )
+                print("Replying with keyset sync")
+                return (200, json.dumps(reply), None)
+            except (httpx.HTTPStatusError, httpx.RequestError, ValueError) as exc:
+                print(f"Could not sync keysets, forwarding the request: {exc}")
+
+        print(f"Crafting http request to {url}")
 
         resp = None
         try:
             if method == "GET":
                 print(f"Doing GET request to {url}")
-                resp = await self.httpx.get(
-                    url, params=params, headers=headers, cookies=cookies
+                resp = await self.get_from_mint(
+                    request["path"], params=params, headers=headers, cookies=cookies
                 )
             elif method == "POST":
                 print(f"Doing POST request to {url}")
@@ -87,28 +788,262 @@ class LXMFWrapperProxy:
                     url,
                     params=params,
                     data=data,
-                    json=json,
+                    json=json_body,
                     headers=headers,
                     cookies=cookies,
                 )
             resp.raise_for_status()
-        except (httpx.HTTPStatusError, httpx.RequestError) as exc:
+        except httpx.HTTPStatusError as exc:
+            # The mint's error (detail and code) goes back to the wallet,
+            # which raises it instead of waiting for a reply forever
+            print(f"The mint replied with an error: {exc}")
+            headers = {
+                name: exc.response.headers[name]
+                for name in FORWARDED_HEADERS
+                if name in exc.response.headers
+            }
+            return (exc.response.status_code, exc.response.text, headers)
+        except httpx.RequestError as exc:
             print(f"An error occurred while handling the HTTP request: {exc}")
-            return None
+            return (
+                502,
+                json.dumps({"detail": f"Proxy cannot reach the mint: {exc}"}),
+                None,
+            )
         if resp is None:
             print("No response was received.")
             return None
 
-        fields = {}
-        fields["req_id"] = req_id
+        reply_text = resp.text
+        if (
+            wants_xpub
+            and self.keyset_xpubs
+            and method == "GET"
+            and KEYS_PATH.match(request["path"])
+        ):
+            xpub_reply = self.xpub_reply_for_keys(resp.text)
+            if xpub_reply is not None:
+                print("Replying with keyset xpub instead of the full keyset")
+                reply_text = json.dumps(xpub_reply)
+
+        if self.recorder is not None:
+            self.recorder.record(
+                "req",
+                request_payload(
+                    method,
+                    request["path"],
+                    params=params,
+                    headers=headers,
+                    cookies=cookies,
+                    data=data,
+                    json=json_body,
+                    schema=SCHEMA_CASHU,
+                ),
+            )
+            self.recorder.record(
+                "resp", response_payload(resp.status_code, reply_text, SCHEMA_CASHU)
+            )
+
+        return (resp.status_code, reply_text, None)
+
+    def decode_request_fields(self, fields, content):
+        """Decodes the request in the fields of a message, content is the
+        path of legacy requests. Returns a tuple of (requests, is_batch), or
+        None if the message must be ignored."""
+        if FIELD_ENVELOPE in fields:
+            try:
+                requests, is_batch = decode_requests(fields[FIELD_ENVELOPE])
+            except Exception as e:
+                print(f"Warning: Could not decode request envelope: {e}, ignoring")
+                return None
+        else:
+            is_batch = False
+            request = {
+                "method": fields.get("method"),
+                "path": content,
+                "params": fields.get("params"),
+                "headers": fields.get("headers"),
+                "cookies": fields.get("cookies"),
+                "data": fields.get("data"),
+                "json": fields.get("json"),
+            }
+            requests = [request]
+
+        # requests with a bad method get no reply in a batch, see
+        # handle_http_request
+        if not is_batch:
+            method = requests[0]["method"]
+            if method is None:
+                print("Warning: Received request without method, ignoring")
+                return None
+
+            if method != "GET" and method != "POST":
+                print(
+                    f"Warning: Received request with unsupported method {method}, ignoring"
+                )
+                return None
+        return (requests, is_batch)
+
+    def print_request(self, req_id, requests, is_batch):
+        if is_batch:
+            print(
+                f"Got a batch of {len(requests)} requests with ID {format_req_id(req_id)}"
+            )
+        else:
+            print(
+                f"Got a request with ID {format_req_id(req_id)} for method {requests[0]['method']}"
+            )
+
+    async def reply_for_requests(self, fields, requests, is_batch):
+        """Runs the requests against the mint and builds the reply in the
+        format the sender understands (fields of the request tell). Returns
+        a tuple of (content, fields) of the reply, or None if there is
+        nothing to reply with. Raises ProxyBusy if the worker pool is
+        full."""
+        # the requests of a batch run concurrently, each on a worker
+        replies = await self.worker_pool.run(
+            request_priority(requests),
+            [
+                lambda request=request: self.handle_http_request(request)
+                for request in requests
+            ],
+        )
+        return self.build_reply(fields, replies, is_batch)
+
+    def retry_reply(self, fields, requests, is_batch, status_code, retry_after):
+        """Reply telling the client to send its requests again in
+        retry_after seconds, 503 when we are busy, 429 when the client sent
+        too much."""
+        retry_after = max(1, math.ceil(retry_after))
+        if status_code == 429:
+            detail = f"Too many requests, retry after {retry_after}s"
+        else:
+            detail = f"Proxy is busy, retry after {retry_after}s"
+        print(detail)
+        reply = (
+            status_code,
+            json.dumps({"detail": detail}),
+            {"retry-after": str(retry_after)},
+        )
+        return self.build_reply(fields, [reply] * len(requests), is_batch)
+
+    def build_reply(self, fields, replies, is_batch):
+        """Builds the reply to requests in the format the sender understands
+        (fields of the request tell). replies are the (status_code, text,
+        headers) of handle_http_request. Returns a tuple of (content,
+        fields) of the reply, or None if there is nothing to reply with."""
+        # Client advertises envelope codecs, answer in the compact format
+        reply_codec = choose_codec(fields.get(FIELD_CODECS))
+        reply_schema = choose_schema(fields.get(FIELD_CODECS))
+        reply_dictionary = choose_dictionary(fields.get(FIELD_DICTIONARIES))
+
+        reply_fields = {}
+        if is_batch:
+            reply_fields[FIELD_ENVELOPE] = encode_batch_response(
+                replies,
+                CODEC_NONE if reply_codec is None else reply_codec,
+                reply_schema,
+                reply_dictionary,
+            )
+            content = ""
+        else:
+            reply = replies[0]
+            if reply is None:
+                return None
+            status_code, reply_text, reply_headers = reply
+            content = reply_text
+            if reply_codec is not None:
+                reply_fields[FIELD_ENVELOPE] = encode_response(
+                    status_code,
+                    reply_text,
+                    reply_codec,
+                    reply_schema,
+                    reply_dictionary,
+                    reply_headers,
+                )
+                content = ""
+            elif status_code != 200:
+                reply_fields[FIELD_STATUS] = status_code
+        if FIELD_ENVELOPE in reply_fields:
+            reply_fields[FIELD_CODECS] = capabilities()
+            if dictionary_ids():
+                reply_fields[FIELD_DICTIONARIES] = dictionary_ids()
+        return (content, reply_fields)
+
+    async def reply_once(self, source_hash, req_id, fields, requests, is_batch):
+        """The reply to requests, from the reply cache for retransmissions,
+        otherwise from the mint through the worker pool. If the client sent
+        too much or the pool is full, a reply asking it to retry later,
+        which is not cached. The reply is charged to the client's budget.
+        Retransmissions are not throttled, the mint may be running the
+        request already and its reply must reach the client."""
+        if (source_hash, req_id) not in self.reply_cache:
+            retry_after = self.rate_limiter.admit(source_hash)
+            if retry_after is not None:
+                return self.retry_reply(fields, requests, is_batch, 429, retry_after)
+        try:
+            reply = await self.reply_cache.get_or_run(
+                (source_hash, req_id),
+                lambda: self.reply_for_requests(fields, requests, is_batch),
+            )
+        except ProxyBusy as busy:
+            return self.retry_reply(fields, requests, is_batch, 503, busy.retry_after)
+        if reply is not None:
+            content, reply_fields = reply
+            self.rate_limiter.charge(
+                source_hash, content_size("", content, reply_fields)
+            )
+        return reply
+
+    async def receive_handler_async(self, lxm):
+        fields = lxm.fields
+        req_id = fields.pop("req_id", None)
+        if req_id is None:
+            print("Warning: Received request without req_id, ignoring")
+            return None
+
+        decoded = self.decode_request_fields(fields, lxm.content_as_string())
+        if decoded is None:
+            return None
+        requests, is_batch = decoded
+        self.print_request(req_id, requests, is_batch)
+
+        started = time.time()
+        known = self.resolver.get(lxm.source_hash) is not None
+        if not known:
+            # RNS forgot the client, or we restarted since it announced
+            known = self.client_identities.remember(lxm.source_hash)
+        lxmf_destination = await self.resolver.resolve(
+            lxm.source_hash, IDENTITY_TIMEOUT
+        )
+        self.client_identities.record_recall(known, time.time() - started)
+        if lxmf_destination is None:
+            print("Error: Cannot recall identity")
+            return None
+        self.client_identities.learn(lxm.source_hash, lxmf_destination.identity)
+
+        reply = await self.reply_once(
+            lxm.source_hash, req_id, fields, requests, is_batch
+        )
+        if reply is None:
+            return None
+        content, fields = reply
+        fields = dict(fields, req_id=req_id)
+
+        # Small replies go as a single packet, unless a link is up anyway
+        size = content_size("ACK", content, fields)
+        link_up = link_is_up(self.lxm_router, lxmf_destination.hash)
+        desired_method = choose_delivery_method(size, link_up)
+        self.delivery_log.record(req_id, size, desired_method, link_up)
+
         # Create the lxm object
         lxm_outbound = LXMF.LXMessage(
             lxmf_destination,
             self.local_lxmf_destination,
-            resp.text,
+            content,
             title="ACK",
             fields=fields,
-            desired_method=LXMF.LXMessage.DIRECT,
+            desired_method=desired_method,
         )
 
         def outbound_delivery_callback(message):
@@ -121,6 +1056,60 @@ class LXMFWrapperProxy:
         await self.lxm_router.handle_outbound(lxm_outbound)
         print("Message sent")
 
+    async def session_handler_async(self, link, fields):
+        req_id = fields.pop("req_id", None)
+        if req_id is None:
+            print("Warning: Received session request without req_id, ignoring")
+            return None
+
+        decoded = self.decode_request_fields(fields, "")
+        if decoded is None:
+            return None
+        requests, is_batch = decoded
+        self.print_request(req_id, requests, is_batch)
+
+        # Clients identify on the session link, then retransmissions hit the
+        # same cache entries whether they come over LXMF or a session
+        identity = link.get_remote_identity()
+        if identity is not None:
+            source_hash = RNS.Destination.hash_from_name_and_identity(
+                "lxmf.delivery", identity
+            )
+            self.client_identities.learn(source_hash, identity)
+        else:
+            source_hash = link.link_id
+
+        # the session's link is our way back, no need to look up the sender
+        reply = await self.reply_once(source_hash, req_id, fields, requests, is_batch)
+        if reply is None:
+            return None
+        _, fields = reply
+        fields = dict(fields)
+        if FIELD_ENVELOPE not in fields:
+            print("Warning: Session request did not offer any codec we know")
+            return None
+        if link.status != RNS.Link.ACTIVE:
+            print(
+                f"Session closed before the reply to {format_req_id(req_id)} was ready"
+            )
+            return None
+        fields["req_id"] = req_id
+        self.delivery_log.record(req_id, content_size("", "", fields), SESSION, True)
+        send_fields(link, fields)
+
+    def session_established(self, link):
+        print(f"Session established: {link}")
+        receive_fields(link, self.session_receive_handler)
+
+    def session_receive_handler(self, link, fields):
+        global loop
+        try:
+            asyncio.run_coroutine_threadsafe(
+                self.session_handler_async(link, fields), loop
+            )
+        except Exception as e:
+            print(f"Exception in session receive handler: {e}")
+
     def receive_handler(self, lxm):
         global loop
         try:
@@ -128,13 +1117,88 @@ class LXMFWrapperProxy:
         except Exception as e:
             print(f"Exception in receive handler: {e}")
 
+    def print_stats(self):
+        print(f"Reply cache: {self.reply_cache.stats()}")
+        print(f"Delivery methods: {dict(self.delivery_log.counts)}")
+        print(f"Client identities: {self.client_identities.stats()}")
+        print(f"Worker pool: {self.worker_pool.stats()}")
+        print(f"Rate limits: {self.rate_limiter.stats()}")
+        for source, levels in self.rate_limiter.levels(below_burst=True).items():
+            print(f"  {source}: {levels}")
+        print(f"Coalesced GET requests: {self.get_coalescer.stats()}")
+        print(f"Response cache: {self.response_cache.stats()}")
+
     def send_announce(self):
         self.local_lxmf_destination.announce()
+        self.session_destination.announce()
+
+    def announce_app_data(self):
+        """LXMF announce app_data with the mint's keyset fingerprint, so
+        wallets hearing the announce can check their cached keysets without
+        sending a request, and our codecs, so they can batch and compress
+        their first requests."""
+        return announce_app_data(
+            self.lxm_router.get_announce_app_data(self.local_lxmf_destination.hash),
+            self.announce_fingerprint,
+            capabilities(),
+        )
+
+    async def update_announce_fingerprint(self):
+        """Fetches the fingerprint of the mint's keysets. Returns True if
+        it changed since the last call."""
+        try:
+            fingerprint = await self.keyset_cache.fingerprint()
+        except (httpx.HTTPStatusError, httpx.RequestError, ValueError, KeyError) as exc:
+            print(f"Could not get keyset fingerprint of the mint: {exc}")
+            return False
+        if fingerprint == self.announce_fingerprint:
+            return False
+        if self.announce_fingerprint is not None:
+            print("Mint keysets changed, dropping cached replies")
+            self.response_cache.invalidate()
+        self.announce_fingerprint = fingerprint
+        return True
 
     def __init__(
-        self, destination_url, identity_config, identity_name="LXMFProxyServer"
+        self,
+        destination_url,
+        identity_config,
+        identity_name="LXMFProxyServer",
+        record_dir=None,
+        keyset_xpubs=None,
+        workers=8,
+        max_queue=64,
+        rate_limiter=None,
     ):
         self.destination_url = destination_url
+        # delivery method chosen for each reply
+        self.delivery_log = DeliveryLog()
+        self.reply_cache = ReplyCache()
+        # at most this many requests go to the mint at once
+        self.worker_pool = WorkerPool(workers, max_queue)
+        # identical GETs in flight at the same time go to the mint once
+        self.get_coalescer = RequestCoalescer()
+        # the mint's replies to reads of its keys and info
+        self.response_cache = ResponseCache()
+        # budgets of messages and reply bytes per client
+        self.rate_limiter = rate_limiter
+        if self.rate_limiter is None:
+            self.rate_limiter = RateLimiter()
+        # LXMF destinations of the clients we reply to
+        self.resolver = DestinationResolver("lxmf", "delivery")
+        # Fingerprint of the mint's keysets in our announces, None until we
+        # talked to the mint
+        self.announce_fingerprint = None
+
+        # xpub -> derived public keys by amount, derived once at startup
+        self.keyset_xpubs = {}
+        for xpub in keyset_xpubs or []:
+            self.keyset_xpubs[xpub] = derive_public_keys(xpub, MAX_ORDER)
+            print(f"Serving keysets derivable from {xpub}")
+        self.recorder = None
+        if record_dir is not None:
+            self.recorder = TrafficRecorder(record_dir)
+            print(f"Recording traffic samples to {record_dir}")
 
         # Name in bytes for transmission purposes
         namebytes = bytes(identity_name, "utf-8")
@@ -162,11 +1226,18 @@ class LXMFWrapperProxy:
             self.ID.to_file(identitypath)
             print(f"Created new identity and saved key to {identitypath}...")
 
+        self.client_identities = ClientIdentityCache(f"{configdir}/client_identities")
+
         self.lxm_router = LXMF.LXMRouter(identity=self.ID, storagepath=configdir)
         self.local_lxmf_destination = self.lxm_router.register_delivery_identity(
             self.ID, display_name=identity_name
         )
-        self.local_lxmf_destination.announce()
+        self.local_lxmf_destination.set_default_app_data(self.announce_app_data)
+        # Clients that keep a link open send requests to this destination
+        self.session_destination = session_destination(self.ID, RNS.Destination.IN)
+        self.session_destination.set_link_established_callback(self.session_established)
+        RNS.Transport.register_announce_handler(self.resolver)
+        self.send_announce()
         print(
             f"Running proxy with identity {RNS.prettyhexrep(self.local_lxmf_destination.hash)} redirecting to {self.destination_url}"
         )
@@ -202,20 +1273,52 @@ class LXMFWrapperProxy:
             base_url=self.destination_url,
             timeout=5,
         )
+        # keysets are watched for changes, replies must not be stale
+        self.keyset_cache = MintKeysetCache(
+            lambda path: self.get_from_mint(path, allow_stale=False)
+        )
 
 
-async def main_event_loop(destination_url, identity_name, announce_delay_time):
+async def main_event_loop(
+    destination_url,
+    identity_name,
+    announce_delay_time,
+    record_dir=None,
+    keyset_xpubs=None,
+    workers=8,
+    max_queue=64,
+    rate_limiter=None,
+):
     print("Initializing proxy...")
-    proxy = LXMFWrapperProxy(destination_url, identity_name)
+    proxy = LXMFWrapperProxy(
+        destination_url,
+        identity_name,
+        record_dir=record_dir,
+        keyset_xpubs=keyset_xpubs,
+        workers=workers,
+        max_queue=max_queue,
+        rate_limiter=rate_limiter,
+    )
+    if dictionary_ids():
+        print(f"Loaded compression dictionaries {dictionary_ids()}")
     print("Listening for requests...")
 
     oldtime = 0
+    fingerprint_time = 0
     while True:
         newtime = time.time()
+        if newtime > fingerprint_time + proxy.keyset_cache.ttl:
+            fingerprint_time = newtime
+            if await proxy.update_announce_fingerprint():
+                print(f"Mint keyset fingerprint is {proxy.announce_fingerprint}")
+                # let wallets know right away
+                oldtime = 0
         if newtime > oldtime + announce_delay_time:
             oldtime = newtime
             proxy.send_announce()
             print("Sent announce to the network...")
+            proxy.print_stats()
+        proxy.client_identities.save()
         await asyncio.sleep(1)
 
 
@@ -224,17 +1327,79 @@ if __name__ == "__main__":
     loop = asyncio.get_event_loop()
     loop.set_debug(True)
 
-    if len(sys.argv) < 3:
-        print(
-            "Usage: python3 lxmf_proxy_server.py <destination_url> <identity_name> [<announce_delay_time>]"
-        )
-        sys.exit(1)
-
-    announce_delay_time = 60 * 30
-    if len(sys.argv) > 3:
-        announce_delay_time = int(sys.argv[3])
+    parser = argparse.ArgumentParser(
+        description="Forwards LXMF requests to a cashu mint over HTTP"
+    )
+    parser.add_argument("destination_url")
+    parser.add_argument("identity_name")
+    parser.add_argument("announce_delay_time", nargs="?", type=int, default=60 * 30)
+    parser.add_argument(
+        "--record-dir",
+        help="store request and reply samples here for train_dictionary.py",
+    )
+    parser.add_argument(
+        "--keyset-xpub",
+        action="append",
+        default=[],
+        help="xpub the mint derives a keyset from (key for 2^i is xpub/i), "
+        "wallets asking for it get the xpub instead of the full keyset. "
+        "Can be given several times.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="number of requests sent to the mint at once",
+    )
+    parser.add_argument(
+        "--max-queue",
+        type=int,
+        default=64,
+        help="requests waiting for a worker before new ones are answered "
+        "with busy, retry later",
+    )
+    parser.add_argument(
+        "--client-messages-per-minute",
+        type=int,
+        default=60,
+        help="requests a client may send per minute on average, 0 for no limit",
+    )
+    parser.add_argument(
+        "--client-message-burst",
+        type=int,
+        default=20,
+        help="requests a client may send at once",
+    )
+    parser.add_argument(
+        "--client-bytes-per-minute",
+        type=int,
+        default=1000000,
+        help="bytes of replies a client may get per minute on average, "
+        "0 for no limit",
+    )
+    parser.add_argument(
+        "--client-byte-burst",
+        type=int,
+        default=250000,
+        help="bytes of replies a client may get at once",
+    )
+    args = parser.parse_args()
 
     loop.run_until_complete(
-        main_event_loop(sys.argv[1], sys.argv[2], announce_delay_time)
+        main_event_loop(
+            args.destination_url,
+            args.identity_name,
+            args.announce_delay_time,
+            args.record_dir,
+            args.keyset_xpub,
+            args.workers,
+            args.max_queue,
+            RateLimiter(
+                args.client_messages_per_minute,
+                args.client_message_burst,
+                args.client_bytes_per_minute,
+                args.client_byte_burst,
+            ),
+        )
     )
     loop.close()
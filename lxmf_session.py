@@ -0,0 +1,90 @@
+"""Request / reply sessions over a RNS.Link.
+
+Instead of a standalone LXMF message per request and per reply, a client
+can open one link to the proxy's session destination and keep it. Both
+sides then send messages made of the same fields LXMF messages carry
+(req_id, the envelope, codecs, ...) over the link: as a single link packet
+when they fit, as a RNS.Resource otherwise. The link setup is paid once per
+session instead of once per request.
+"""
+
+import RNS
+import RNS.vendor.umsgpack as umsgpack
+
+from lxmf_codec import CODEC_ZLIB, FEATURE_BATCH, SCHEMA_CASHU
+
+# The session destination is derived from the proxy identity, a client that
+# knows the proxy's LXMF address knows its session destination too
+APP_NAME = "nutband"
+ASPECT = "session"
+
+# Everything that accepts sessions understands at least these, so a client
+# can use the envelope on the first request of a session
+SESSION_CAPABILITIES = [CODEC_ZLIB, SCHEMA_CASHU, FEATURE_BATCH]
+
+# Larger resources are refused, nothing in the cashu API comes close
+MAX_RESOURCE_SIZE = 1024 * 1024
+
+
+def session_destination(identity, direction):
+    """The session destination of identity, RNS.Destination.IN on the proxy
+    and RNS.Destination.OUT on the client."""
+    return RNS.Destination(
+        identity, direction, RNS.Destination.SINGLE, APP_NAME, ASPECT
+    )
+
+
+class SessionMessage:
+    """A message received over a session. Has the attributes of LXMessage
+    the request and reply handling reads."""
+
+    def __init__(self, fields, source_hash):
+        self.fields = fields
+        self.source_hash = source_hash
+        self.content = b""
+
+    def content_as_string(self):
+        return self.content.decode("utf-8")
+
+
+def send_fields(link, fields):
+    """Sends a message (a dict of fields) over link, in one packet if it
+    fits, otherwise as a resource."""
+    data = umsgpack.packb(fields)
+    if len(data) <= RNS.Link.MDU:
+        RNS.Packet(link, data).send()
+    else:
+        RNS.Resource(data, link)
+
+
+def receive_fields(link, callback):
+    """Calls callback(link, fields) for every message that arrives over
+    link, whether it came as a packet or as a resource."""
+
+    def deliver(data):
+        try:
+            fields = umsgpack.unpackb(data)
+        except Exception as e:
+            print(f"Warning: Could not decode session message: {e}, ignoring")
+            return
+        if not isinstance(fields, dict):
+            print("Warning: Received session message that is not a map, ignoring")
+            return
+        callback(link, fields)
+
+    def packet_received(message, packet):
+        deliver(message)
+
+    def resource_advertised(resource):
+        return resource.get_data_size() <= MAX_RESOURCE_SIZE
+
+    def resource_concluded(resource):
+        if resource.status == RNS.Resource.COMPLETE:
+            deliver(resource.data.read())
+        else:
+            print("Warning: Session resource transfer failed")
+
+    link.set_packet_callback(packet_received)
+    link.set_resource_strategy(RNS.Link.ACCEPT_APP)
+    link.set_resource_callback(resource_advertised)
+    link.set_resource_concluded_callback(resource_concluded)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import math
 import pathlib
@@ -7,6 +8,20 @@ from itertools import groupby
 from posixpath import join
 from typing import Dict, List, Optional, Tuple, Union
 from lxmf_wrapper_client import LXMFWrapperClient, LXMFProxy
+from url_routing import RoutingTable, all_destinations, destinations_of
+from keyset_sync import (
+    KEYSETS_KNOWN_HEADER,
+    encode_known_keysets,
+    fingerprint_matches,
+    is_sync_reply,
+    keyset_hash,
+)
+from xpub_keysets import (
+    KEYS_FORMAT_HEADER,
+    KEYS_FORMAT_XPUB,
+    derive_public_keys,
+    is_xpub_keys_reply,
+)
 
 import bolt11
 import httpx
@@ -25,6 +40,7 @@ from cashu.core.base import (
     WalletKeyset,
 )
 from cashu.core.crypto import b_dhke
+from cashu.core.crypto.keys import derive_keyset_id, derive_keyset_id_deprecated
 from cashu.core.crypto.secp import PrivateKey, PublicKey
 from cashu.core.db import Database
 from cashu.core.helpers import calculate_number_of_blank_outputs, sum_proofs
@@ -57,6 +73,7 @@ from cashu.wallet.crud import (
     store_keyset,
     store_lightning_invoice,
     store_proof,
+    update_keyset,
     update_lightning_invoice,
     update_proof,
 )
@@ -66,10 +83,14 @@ from cashu.wallet.p2pk import WalletP2PK
 from cashu.wallet.secrets import WalletSecrets
 
 
+CONFIG_PATH = pathlib.Path(__file__).with_name("config.json")
+# How often (in seconds) TransportRegistry looks for changes of the config
+CONFIG_CHECK_INTERVAL = 5
+
+
 def load_config():
     try:
-        f = pathlib.Path(__file__).with_name("config.json")
-        config = json.load(f.open())
+        config = json.load(CONFIG_PATH.open())
     except FileNotFoundError:
         raise FileNotFoundError(
             "File lxmf_wallet/config.json not found. "
@@ -79,57 +100,176 @@ def load_config():
     return config
 
 
+def load_mappings(config):
+    """Returns the mint URL -> proxy destination (or list of proxy
+    destinations) mappings of config, checking that they are legit."""
+    mappings = config["mappings"]
+    for k, v in mappings.items():
+        assert k.startswith("https://"), "mapping URLs must start with https://"
+        assert isinstance(v, str) or (
+            isinstance(v, list) and len(v) > 0
+        ), "mappings must be a destination or a non-empty list of them"
+        for destination in destinations_of(v):
+            assert (
+                isinstance(destination, str)
+                and len(destination) == 32
+                and all(c in "0123456789abcdef" for c in destination)
+            ), "mapping destinations must be lowercase hex strings of length 32"
+    return mappings
+
+
+class TransportRegistry:
+    """The transport stack shared by all wallets of the process. The config
+    is loaded and checked once, and each mapping gets one httpx.AsyncClient
+    and one LXMFProxy, which every wallet of a mint under that mapping
+    borrows instead of building its own.
+
+    The config file is checked for changes every CONFIG_CHECK_INTERVAL
+    seconds. New mappings are swapped into the live proxies and passed to
+    the listeners, see add_listener()."""
+
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(TransportRegistry, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if (not hasattr(self, "proxies")) or (self.proxies is None):
+            self.config = None
+            self.mappings = None
+            self.routes = None
+            # mapping URL (mint URL for unmapped mints) -> LXMFProxy
+            self.proxies = {}
+            self.tor = None
+            self.config_mtime = None
+            self.watch_task = None
+            # called with (old mappings, new mappings) after a reload
+            self.listeners = [self.prewarm_mappings]
+
+    def load(self):
+        if self.config is None:
+            config = load_config()
+            self.config_mtime = CONFIG_PATH.stat().st_mtime_ns
+            self.mappings = load_mappings(config)
+            self.routes = RoutingTable(self.mappings)
+            self.config = config
+            self.watch_task = asyncio.create_task(self.watch_config())
+
+    def add_listener(self, listener):
+        """listener(old_mappings, new_mappings) is called every time changed
+        mappings were loaded from the config file."""
+        self.listeners.append(listener)
+
+    async def watch_config(self):
+        while True:
+            await asyncio.sleep(CONFIG_CHECK_INTERVAL)
+            try:
+                self.reload_if_changed()
+            except Exception as e:
+                logger.warning(f"Could not reload {CONFIG_PATH}: {e}")
+
+    def reload_if_changed(self):
+        """Loads the config file again if it changed since we last did.
+        Returns True if it did. If the new config is broken, raises an
+        exception and keeps the old one."""
+        mtime = CONFIG_PATH.stat().st_mtime_ns
+        if mtime == self.config_mtime:
+            return False
+        self.config_mtime = mtime
+        config = load_config()
+        mappings = load_mappings(config)
+        old_mappings = self.mappings
+        self.config = config
+        if mappings != old_mappings:
+            routes = RoutingTable(mappings)
+            self.mappings = mappings
+            self.routes = routes
+            for proxy in self.proxies.values():
+                proxy.set_mappings(mappings, routes)
+            logger.info(f"Reloaded mappings from {CONFIG_PATH}")
+            for listener in self.listeners:
+                listener(old_mappings, mappings)
+        return True
+
+    def prewarm_mappings(self, old_mappings, new_mappings):
+        LXMFWrapperClient().prewarm(all_destinations(new_mappings))
+
+    def prewarm(self):
+        """Starts the LXMF client and looks up all mapped proxies in the
+        background, so they are known by the time a wallet talks to a mint."""
+        self.load()
+        LXMFWrapperClient().prewarm(all_destinations(self.mappings))
+
+    def mapping_for(self, url):
+        prefix, _ = self.routes.lookup(url)
+        if prefix is None:
+            return url
+        return prefix
+
+    def proxy_for(self, url):
+        """Returns the LXMFProxy for the mint at url."""
+        self.load()
+        key = self.mapping_for(url)
+        proxy = self.proxies.get(key)
+        if proxy is None:
+            # wrapper client has its own temporary identity and registers
+            # in the reticulum network.
+            proxy = LXMFProxy(
+                LXMFWrapperClient(),
+                self.httpx_client(key),
+                False,
+                self.mappings,
+                session_mode=self.config.get("session_mode", False),
+                request_timeout=self.config.get("request_timeout", 60),
+                max_attempts=self.config.get("max_attempts", 3),
+                request_backoff=self.config.get("request_backoff", 2),
+                request_deadline=self.config.get("request_deadline", 300),
+                routes=self.routes,
+                hedge_delay=self.config.get("hedge_delay"),
+            )
+            self.proxies[key] = proxy
+        return proxy
+
+    def httpx_client(self, base_url):
+        # set proxy
+        proxies_dict = {}
+        proxy_url: Union[str, None] = None
+        if settings.tor and TorProxy().check_platform():
+            if self.tor is None:
+                self.tor = TorProxy(timeout=True)
+                self.tor.run_daemon(verbose=True)
+            proxy_url = "socks5://localhost:9050"
+        elif settings.socks_proxy:
+            proxy_url = f"socks5://{settings.socks_proxy}"
+        elif settings.http_proxy:
+            proxy_url = settings.http_proxy
+        if proxy_url:
+            proxies_dict.update({"all://": proxy_url})
+
+        headers_dict = {"Client-version": settings.version}
+
+        return httpx.AsyncClient(
+            verify=not settings.debug,
+            proxies=proxies_dict,  # type: ignore
+            headers=headers_dict,
+            base_url=base_url,
+            timeout=5,
+        )
+
+
 def async_set_httpx_client(func):
     """
     Decorator that wraps around any async class method of LedgerAPI that makes
-    API calls. Sets some HTTP headers and starts a Tor instance if none is
-    already running and and sets local proxy to use it.
+    API calls. Borrows the LXMFProxy of the mint from the TransportRegistry,
+    which sets some HTTP headers and starts a Tor instance if none is already
+    running and sets local proxy to use it.
     """
 
     async def wrapper(self, *args, **kwargs):
         if (not hasattr(self, "httpx")) or (self.httpx is None):
-
-            # set proxy
-            proxies_dict = {}
-            proxy_url: Union[str, None] = None
-            if settings.tor and TorProxy().check_platform():
-                self.tor = TorProxy(timeout=True)
-                self.tor.run_daemon(verbose=True)
-                proxy_url = "socks5://localhost:9050"
-            elif settings.socks_proxy:
-                proxy_url = f"socks5://{settings.socks_proxy}"
-            elif settings.http_proxy:
-                proxy_url = settings.http_proxy
-            if proxy_url:
-                proxies_dict.update({"all://": proxy_url})
-
-            headers_dict = {"Client-version": settings.version}
-
-            httpx_real = httpx.AsyncClient(
-                verify=not settings.debug,
-                proxies=proxies_dict,  # type: ignore
-                headers=headers_dict,
-                base_url=self.url,
-                timeout=5,
-            )
-
-            # create LXMF proxy that wraps this httpx_real
-
-            # wrapper client has its own temporary identity and registers
-            # in the reticulum network.
-
-            wrapper_client = LXMFWrapperClient()
-
-            config = load_config()
-            # check whether mappings are legit
-            mappings = config["mappings"]
-            for k, v in mappings.items():
-                assert k.startswith("https://"), "mapping URLs must start with https://"
-                assert len(v) == 32 and all(
-                    c in "0123456789abcdef" for c in v
-                ), "mapping destinations must be lowercase hex strings of length 32"
-
-            self.httpx = LXMFProxy(wrapper_client, httpx_real, False, mappings)
+            self.httpx = TransportRegistry().proxy_for(self.url)
 
         return await func(self, *args, **kwargs)
 
@@ -179,7 +319,12 @@ class LedgerAPI(object):
         Raises:
             Exception: if the response contains an error
         """
-        resp_dict = resp.json()
+        try:
+            resp_dict = resp.json()
+        except ValueError:
+            # an error page instead of a cashu error
+            resp.raise_for_status()
+            raise
         if "detail" in resp_dict:
             logger.trace(f"Error from mint: {resp_dict}")
             error_message = f"Mint Error: {resp_dict['detail']}"
@@ -194,7 +339,8 @@ class LedgerAPI(object):
 
         Args:
             keyset_id (str, optional): keyset id to load. If given, requests keys for this keyset
-            from the mint. If not given, requests current keyset of the mint. Defaults to "".
+            from the mint. If not given, requests current keyset of the mint, or syncs the
+            keysets we have with it (see `_sync_mint_keysets`). Defaults to "".
 
         Raises:
             AssertionError: if mint URL is not set
@@ -204,6 +350,12 @@ class LedgerAPI(object):
             self.url
         ), "Ledger not initialized correctly: mint URL not specified yet. "
 
+        if not keyset_id and self.keysets:
+            # the keyset sync only sends the current keyset if we lack it
+            logger.trace("Syncing keysets with the mint.")
+            await self._sync_mint_keysets()
+            return
+
         keyset_local: Union[WalletKeyset, None] = None
         if keyset_id:
             # check if current keyset is in db
@@ -244,10 +396,7 @@ class LedgerAPI(object):
 
         # if the keyset is not in the database, store it
         if keyset_local is None:
-            keyset_local_from_mint = await get_keysets(keyset.id, db=self.db)
-            if not keyset_local_from_mint:
-                logger.debug(f"Storing new mint keyset: {keyset.id}")
-                await store_keyset(keyset=keyset, db=self.db)
+            await self._store_mint_keyset(keyset)
 
         # set current keyset id
         self.keyset_id = keyset.id
@@ -256,8 +405,116 @@ class LedgerAPI(object):
         # add keyset to keysets dict
         self.keysets[keyset.id] = keyset
 
-    async def _load_mint_keysets(self) -> List[str]:
-        """Loads the keyset IDs of the mint.
+    async def _set_current_keyset(self, keyset: WalletKeyset) -> None:
+        """Stores the current keyset of the mint we just received and makes it
+        the current keyset of the wallet."""
+        assert len(keyset.public_keys) > 0, "did not receive keys from mint."
+        await self._store_mint_keyset(keyset)
+        self.keyset_id = keyset.id
+        self.keysets[keyset.id] = keyset
+        logger.debug(f"Current mint keyset: {self.keyset_id}")
+
+    async def _store_mint_keyset(self, keyset: WalletKeyset) -> None:
+        """Stores a keyset received from the mint if it is not in the database yet."""
+        keyset_local_from_mint = await get_keysets(keyset.id, db=self.db)
+        if not keyset_local_from_mint:
+            logger.debug(f"Storing new mint keyset: {keyset.id}")
+            await store_keyset(keyset=keyset, db=self.db)
+
+    def _known_keyset_hashes(self) -> Dict[str, str]:
+        """Returns keyset id -> keyset hash of the mint's keysets we have, for
+        the keyset sync."""
+        known_ids = getattr(self, "mint_keyset_ids", None) or list(self.keysets)
+        return {
+            keyset_id: keyset_hash(
+                {
+                    amt: key.serialize().hex()
+                    for amt, key in self.keysets[keyset_id].public_keys.items()
+                }
+            )
+            for keyset_id in known_ids
+            if keyset_id in self.keysets
+        }
+
+    async def _sync_mint_keysets(self, reply: Optional[dict] = None) -> bool:
+        """Sends the ids and hashes of the keysets we have to the mint's LXMF
+        proxy, which answers with the current and active keyset ids and only
+        the keysets that changed. On a stable mint that is one tiny message.
+
+        Proxies without a keyset cache and plain HTTP mints return the full
+        current keyset instead, which is loaded as `_load_mint_keys` would.
+
+        Args:
+            reply (dict, optional): reply to the keyset sync request if it was
+                already sent. Defaults to None.
+
+        Returns:
+            bool: True if `self.keyset_id` and `self.mint_keyset_ids` were
+            synced, False if only the current keyset was loaded and the
+            active keyset ids still need to be loaded.
+        """
+        if reply is None:
+            reply = await self._get_keys_changes(self.url, self._known_keyset_hashes())
+        if not is_sync_reply(reply):
+            assert len(reply), Exception("did not receive any keys")
+            keyset = WalletKeyset(
+                unit="sat",
+                public_keys={
+                    int(amt): PublicKey(bytes.fromhex(val), raw=True)
+                    for amt, val in reply.items()
+                },
+                mint_url=self.url,
+            )
+            await self._set_current_keyset(keyset)
+            return False
+
+        for keyset_id, keys in reply.get("keys", {}).items():
+            logger.debug(f"Keyset {keyset_id} changed on the mint.")
+            keyset = WalletKeyset(
+                unit="sat",
+                id=keyset_id,
+                public_keys={
+                    int(amt): PublicKey(bytes.fromhex(val), raw=True)
+                    for amt, val in keys.items()
+                },
+                mint_url=self.url,
+            )
+            await self._store_mint_keyset(keyset)
+            self.keysets[keyset_id] = keyset
+        assert reply["current"] in self.keysets, "proxy did not send current keyset"
+        self.keyset_id = reply["current"]
+        self.mint_keyset_ids = reply["active"]
+        logger.debug(
+            f"Synced keysets, current: {self.keyset_id}, active: {self.mint_keyset_ids}"
+        )
+        return True
+
+    @async_set_httpx_client
+    async def _announced_fingerprint(self) -> Optional[list]:
+        """Returns the keyset fingerprint the mint's LXMF proxy recently put
+        in its announce, or None if we have not heard one."""
+        return self.httpx.announced_fingerprint(self.url)
+
+    async def _keysets_match_announce(self) -> bool:
+        """Checks `self.keyset_id` and `self.mint_keyset_ids` against the
+        fingerprint the mint's proxy announced, without sending a request."""
+        keyset_id = getattr(self, "keyset_id", None)
+        mint_keyset_ids = getattr(self, "mint_keyset_ids", None)
+        if not keyset_id or not mint_keyset_ids or keyset_id not in self.keysets:
+            return False
+        return fingerprint_matches(
+            await self._announced_fingerprint(), keyset_id, mint_keyset_ids
+        )
+
+    async def _load_mint_keysets(
+        self, resp: Union[Response, Exception, None] = None
+    ) -> List[str]:
+        """Loads the keyset IDs of the mint. Does not ask the mint if the
+        ones we have match the fingerprint its proxy announced.
+
+        Args:
+            resp (Response, optional): response to the keysets request if it was
+                already sent, or the exception it failed with. Defaults to None.
 
         Returns:
             List[str]: list of keyset IDs of the mint
@@ -265,9 +522,17 @@ class LedgerAPI(object):
         Raises:
             AssertionError: if no keysets are received from the mint
         """
+        if resp is None and await self._keysets_match_announce():
+            logger.debug(f"Mint keysets match announce: {self.mint_keyset_ids}")
+            return self.mint_keyset_ids
         mint_keysets = []
         try:
-            mint_keysets = await self._get_keyset_ids(self.url)
+            if resp is None:
+                mint_keysets = await self._get_keyset_ids(self.url)
+            elif isinstance(resp, Exception):
+                raise resp
+            else:
+                mint_keysets = self._parse_keyset_ids(resp)
         except Exception:
             assert self.keysets[
                 self.keyset_id
@@ -277,8 +542,27 @@ class LedgerAPI(object):
         logger.debug(f"Mint keysets: {self.mint_keyset_ids}")
         return self.mint_keyset_ids
 
-    async def _load_mint_info(self) -> GetInfoResponse:
-        """Loads the mint info from the mint."""
+    async def _load_mint_info(
+        self, resp: Union[Response, Exception, None] = None
+    ) -> GetInfoResponse:
+        """Loads the mint info from the mint, unless we have it and the
+        mint's proxy announced the same version.
+
+        Args:
+            resp (Response, optional): response to the info request if it was
+                already sent, or the exception it failed with. Defaults to None.
+        """
+        if isinstance(resp, Exception):
+            raise resp
+        if resp is not None:
+            self.mint_info = self._parse_info(resp)
+            logger.debug(f"Mint info: {self.mint_info}")
+            return self.mint_info
+        mint_info = getattr(self, "mint_info", None)
+        if mint_info is not None and mint_info.version:
+            fingerprint = await self._announced_fingerprint()
+            if fingerprint is not None and fingerprint[2] == mint_info.version:
+                return mint_info
         self.mint_info = await self._get_info(self.url)
         logger.debug(f"Mint info: {self.mint_info}")
         return self.mint_info
@@ -290,10 +574,17 @@ class LedgerAPI(object):
         Gets the active keyset ids of the mint and stores in `self.mint_keyset_ids`.
         """
 
-        await self._load_mint_keys(keyset_id)
-        await self._load_mint_keysets()
+        info_resp = None
+        if keyset_id:
+            await self._load_mint_keys(keyset_id)
+            await self._load_mint_keysets()
+        elif await self._keysets_match_announce():
+            logger.debug("Cached keysets match the mint's announce.")
+        else:
+            # keys, keyset ids and info in one round trip
+            info_resp = await self._load_mint_state()
         try:
-            await self._load_mint_info()
+            await self._load_mint_info(info_resp)
         except Exception as e:
             logger.debug(f"Could not load mint info: {e}")
             pass
@@ -303,6 +594,67 @@ class LedgerAPI(object):
                 keyset_id in self.mint_keyset_ids
             ), f"keyset {keyset_id} not active on mint"
 
+    @async_set_httpx_client
+    async def _load_mint_state(self) -> Union[Response, Exception]:
+        """Loads the current keyset and the active keyset ids of the mint and
+        asks for the mint info in the same batch of requests, which the LXMF
+        proxy answers in a single reply. If we have keysets cached, the keys
+        request is a keyset sync that brings the active keyset ids along.
+
+        Returns:
+            Union[Response, Exception]: response to the info request for
+            `_load_mint_info`, or the exception it failed with
+        """
+        keys_url = join(self.url, "keys")
+        if self.keysets:
+            known = encode_known_keysets(self._known_keyset_hashes())
+            requests = [("GET", keys_url, {"headers": {KEYSETS_KNOWN_HEADER: known}})]
+        else:
+            requests = [
+                ("GET", keys_url, {"headers": {KEYS_FORMAT_HEADER: KEYS_FORMAT_XPUB}}),
+                ("GET", join(self.url, "keysets")),
+            ]
+        requests.append(("GET", join(self.url, "info")))
+        responses = await self.httpx.gather_requests(requests, return_exceptions=True)
+
+        keys_resp = responses[0]
+        if isinstance(keys_resp, Exception):
+            raise keys_resp
+        if self.keysets:
+            self.raise_on_error(keys_resp)
+            if not await self._sync_mint_keysets(keys_resp.json()):
+                await self._load_mint_keysets()
+        else:
+            keyset_keys = await self._download_keyset_keys(keys_url, resp=keys_resp)
+            await self._set_current_keyset(
+                WalletKeyset(unit="sat", public_keys=keyset_keys, mint_url=self.url)
+            )
+            await self._load_mint_keysets(responses[1])
+        return responses[-1]
+
+    async def _load_mint_from_db(self) -> bool:
+        """Loads the keysets of the mint we already know from the database,
+        without talking to the mint. Sets `self.keysets`, `self.keyset_id`
+        (the most recently seen active keyset) and `self.mint_keyset_ids`.
+
+        Returns:
+            bool: False if there is no keyset of this mint in the database
+        """
+        keysets = await get_keysets(mint_url=self.url, db=self.db)
+        if not keysets:
+            return False
+        for keyset in keysets:
+            self.keysets[keyset.id] = keyset
+        active_keysets = [k for k in keysets if k.active] or keysets
+        current_keyset = max(active_keysets, key=lambda k: int(k.first_seen or 0))
+        self.keyset_id = current_keyset.id
+        self.mint_keyset_ids = [k.id for k in active_keysets]
+        logger.debug(
+            f"Loaded keysets {self.mint_keyset_ids} of {self.url} from database,"
+            f" current keyset: {self.keyset_id}"
+        )
+        return True
+
     async def _check_used_secrets(self, secrets):
         """Checks if any of the secrets have already been used"""
         logger.trace("Checking secrets.")
@@ -315,6 +667,59 @@ class LedgerAPI(object):
     ENDPOINTS
     """
 
+    async def _download_keyset_keys(
+        self, url: str, keyset_id: Optional[str] = None, resp: Optional[Response] = None
+    ) -> Dict[int, PublicKey]:
+        """Downloads the keys at url. Asks for the keyset's xpub first and
+        derives the keys locally, the LXMF proxy answers with the xpub if the
+        mint's keys are derivable from it. Falls back to downloading the
+        full keyset if we get the full keyset anyway, or if the derived keys
+        do not match the keyset id.
+
+        Args:
+            url (str): URL of the keys endpoint
+            keyset_id (str, optional): keyset id the keys must match, if not given
+                the id in the xpub reply is used.
+            resp (Response, optional): response to the xpub request if it was
+                already sent. Defaults to None.
+
+        Returns:
+            Dict[int, PublicKey]: public keys by amount
+        """
+        if resp is None:
+            resp = await self.httpx.get(
+                url, headers={KEYS_FORMAT_HEADER: KEYS_FORMAT_XPUB}
+            )
+        self.raise_on_error(resp)
+        keys: dict = resp.json()
+        assert len(keys), Exception("did not receive any keys")
+        if is_xpub_keys_reply(keys):
+            keyset_keys = {
+                amt: PublicKey(key, raw=True)
+                for amt, key in derive_public_keys(
+                    keys["xpub"], keys["n"], keys["scheme"]
+                ).items()
+            }
+            expected_id = keyset_id or keys["id"]
+            if expected_id in (
+                derive_keyset_id(keyset_keys),
+                derive_keyset_id_deprecated(keyset_keys),
+            ):
+                logger.debug(f"Derived keyset {expected_id} from xpub.")
+                return keyset_keys
+            logger.warning(
+                f"Keys derived from xpub do not match keyset {expected_id},"
+                " downloading the full keyset."
+            )
+            resp = await self.httpx.get(url)
+            self.raise_on_error(resp)
+            keys = resp.json()
+            assert len(keys), Exception("did not receive any keys")
+        return {
+            int(amt): PublicKey(bytes.fromhex(val), raw=True)
+            for amt, val in keys.items()
+        }
+
     @async_set_httpx_client
     async def _get_keys(self, url: str) -> WalletKeyset:
         """API that gets the current keys of the mint
@@ -328,18 +733,29 @@ class LedgerAPI(object):
         Raises:
             Exception: If no keys are received from the mint
         """
+        keyset_keys = await self._download_keyset_keys(join(url, "keys"))
+        keyset = WalletKeyset(unit="sat", public_keys=keyset_keys, mint_url=url)
+        return keyset
+
+    @async_set_httpx_client
+    async def _get_keys_changes(self, url: str, known: Dict[str, str]) -> dict:
+        """API that asks for the current keys with the keysets we know in a
+        header. Returns either a keyset sync reply or, if the proxy does not
+        support it, the current keys of the mint.
+
+        Args:
+            url (str): Mint URL
+            known (Dict[str, str]): keyset id -> keyset hash of keysets we have
+
+        Returns:
+            dict: sync reply or amount -> public key of the current keyset
+        """
         resp = await self.httpx.get(
             join(url, "keys"),
+            headers={KEYSETS_KNOWN_HEADER: encode_known_keysets(known)},
         )
         self.raise_on_error(resp)
-        keys: dict = resp.json()
-        assert len(keys), Exception("did not receive any keys")
-        keyset_keys = {
-            int(amt): PublicKey(bytes.fromhex(val), raw=True)
-            for amt, val in keys.items()
-        }
-        keyset = WalletKeyset(unit="sat", public_keys=keyset_keys, mint_url=url)
-        return keyset
+        return resp.json()
 
     @async_set_httpx_client
     async def _get_keys_of_keyset(self, url: str, keyset_id: str) -> WalletKeyset:
@@ -357,16 +773,9 @@ class LedgerAPI(object):
             Exception: If no keys are received from the mint
         """
         keyset_id_urlsafe = keyset_id.replace("+", "-").replace("/", "_")
-        resp = await self.httpx.get(
-            join(url, f"keys/{keyset_id_urlsafe}"),
+        keyset_keys = await self._download_keyset_keys(
+            join(url, f"keys/{keyset_id_urlsafe}"), keyset_id
         )
-        self.raise_on_error(resp)
-        keys = resp.json()
-        assert len(keys), Exception("did not receive any keys")
-        keyset_keys = {
-            int(amt): PublicKey(bytes.fromhex(val), raw=True)
-            for amt, val in keys.items()
-        }
         keyset = WalletKeyset(
             unit="sat",
             id=keyset_id,
@@ -392,6 +801,9 @@ class LedgerAPI(object):
         resp = await self.httpx.get(
             join(url, "keysets"),
         )
+        return self._parse_keyset_ids(resp)
+
+    def _parse_keyset_ids(self, resp: Response) -> List[str]:
         self.raise_on_error(resp)
         keysets_dict = resp.json()
         keysets = KeysetsResponse.parse_obj(keysets_dict)
@@ -414,6 +826,9 @@ class LedgerAPI(object):
         resp = await self.httpx.get(
             join(url, "info"),
         )
+        return self._parse_info(resp)
+
+    def _parse_info(self, resp: Response) -> GetInfoResponse:
         self.raise_on_error(resp)
         data: dict = resp.json()
         mint_info: GetInfoResponse = GetInfoResponse.parse_obj(data)
@@ -598,12 +1013,35 @@ class LedgerAPI(object):
         """
         Asks the mint to restore promises corresponding to outputs.
         """
-        payload = PostMintRequest(outputs=outputs)
-        resp = await self.httpx.post(join(self.url, "restore"), json=payload.dict())
-        self.raise_on_error(resp)
-        response_dict = resp.json()
-        returnObj = PostRestoreResponse.parse_obj(response_dict)
-        return returnObj.outputs, returnObj.promises
+        (restored,) = await self.restore_promises_batch([outputs])
+        return restored
+
+    @async_set_httpx_client
+    @async_ensure_mint_loaded
+    async def restore_promises_batch(
+        self, outputs_list: List[List[BlindedMessage]]
+    ) -> List[Tuple[List[BlindedMessage], List[BlindedSignature]]]:
+        """
+        Asks the mint to restore promises for several lists of outputs, sends
+        all the requests in one batch.
+        """
+        responses = await self.httpx.gather_requests(
+            [
+                (
+                    "POST",
+                    join(self.url, "restore"),
+                    {"json": PostMintRequest(outputs=outputs).dict()},
+                )
+                for outputs in outputs_list
+            ]
+        )
+        restored = []
+        for resp in responses:
+            self.raise_on_error(resp)
+            response_dict = resp.json()
+            returnObj = PostRestoreResponse.parse_obj(response_dict)
+            restored.append((returnObj.outputs, returnObj.promises))
+        return restored
 
 
 class Wallet(LedgerAPI, WalletP2PK, WalletHTLC, WalletSecrets):
@@ -631,6 +1069,7 @@ class Wallet(LedgerAPI, WalletP2PK, WalletHTLC, WalletSecrets):
         self.db = Database("wallet", db)
         self.proofs: List[Proof] = []
         self.name = name
+        self.mint_refresh_task: Optional[asyncio.Task] = None
 
         super().__init__(url=url, db=self.db)
         logger.debug(f"Wallet initialized with mint URL {url}")
@@ -655,6 +1094,7 @@ class Wallet(LedgerAPI, WalletP2PK, WalletHTLC, WalletSecrets):
             Wallet: Initialized wallet.
         """
         self = cls(url=url, db=db, name=name)
+        TransportRegistry().prewarm()
         await self._migrate_database()
         if not skip_private_key:
             await self._init_private_key()
@@ -678,6 +1118,61 @@ class Wallet(LedgerAPI, WalletP2PK, WalletHTLC, WalletSecrets):
         """
         await super()._load_mint(keyset_id)
 
+    @async_set_httpx_client
+    async def mint_readiness(self) -> Optional[str]:
+        """Whether the mint's LXMF proxy is still being looked up, reachable
+        or unreachable (RESOLVING, READY or UNREACHABLE of
+        lxmf_wrapper_client). None if the mint is not mapped to a proxy."""
+        return self.httpx.destination_ready(self.url)
+
+    async def load_mint_offline_first(self, refresh: bool = True) -> bool:
+        """Loads the mint's keysets from the database so the wallet can be used
+        right away, and refreshes them from the mint in a background task
+        (`self.mint_refresh_task`). If the mint is not in the database yet,
+        loads it from the mint like `load_mint`.
+
+        Args:
+            refresh (bool, optional): Refresh from the mint in the background. Defaults to True.
+
+        Returns:
+            bool: True if the keysets were loaded from the database
+        """
+        if not await self._load_mint_from_db():
+            await self.load_mint()
+            return False
+        if refresh and (
+            self.mint_refresh_task is None or self.mint_refresh_task.done()
+        ):
+            self.mint_refresh_task = asyncio.create_task(self._refresh_mint())
+        return True
+
+    async def _refresh_mint(self) -> bool:
+        """Reloads the keysets from the mint and reconciles them with the ones
+        loaded from the database: keysets the mint no longer lists as active
+        are marked inactive, new ones are stored by `_load_mint_keys`.
+
+        Returns:
+            bool: True if the refresh succeeded
+        """
+        cached_keyset_id = self.keyset_id
+        try:
+            await self._load_mint()
+        except Exception as e:
+            logger.warning(f"Could not refresh mint {self.url}: {e}")
+            return False
+        if self.keyset_id != cached_keyset_id:
+            logger.info(
+                f"Mint {self.url} switched keyset from {cached_keyset_id} to"
+                f" {self.keyset_id}"
+            )
+        for keyset in self.keysets.values():
+            active = keyset.id in self.mint_keyset_ids
+            if keyset.active != active:
+                logger.debug(f"Marking keyset {keyset.id} as active={active}")
+                keyset.active = active
+                await update_keyset(keyset=keyset, db=self.db)
+        return True
+
     async def load_proofs(self, reload: bool = False) -> None:
         """Load all proofs from the database."""
 
@@ -1387,15 +1882,21 @@ class Wallet(LedgerAPI, WalletP2PK, WalletHTLC, WalletSecrets):
         i = counter_before
         n_last_restored_proofs = 0
         while stop_counter < to:
-            print(f"Restoring token {i} to {i + batch}...")
-            restored_proofs = await self.restore_promises_from_to(i, i + batch - 1)
-            if len(restored_proofs) == 0:
-                stop_counter += 1
-            spendable_proofs = await self.invalidate(restored_proofs)
-            if len(spendable_proofs):
-                n_last_restored_proofs = len(spendable_proofs)
-                print(f"Restored {sum_proofs(restored_proofs)} sat")
-            i += batch
+            # ask for as many batches at once as it takes to stop if they all
+            # come back empty, so we never ask for more than the loop uses
+            ranges = [
+                (i + k * batch, i + (k + 1) * batch - 1)
+                for k in range(to - stop_counter)
+            ]
+            print(f"Restoring token {i} to {i + batch * len(ranges)}...")
+            for restored_proofs in await self.restore_promises_from_ranges(ranges):
+                if len(restored_proofs) == 0:
+                    stop_counter += 1
+                spendable_proofs = await self.invalidate(restored_proofs)
+                if len(spendable_proofs):
+                    n_last_restored_proofs = len(spendable_proofs)
+                    print(f"Restored {sum_proofs(restored_proofs)} sat")
+                i += batch
 
         # restore the secret counter to its previous value for the last round
         revert_counter_by = batch * to + n_last_restored_proofs
@@ -1424,27 +1925,50 @@ class Wallet(LedgerAPI, WalletP2PK, WalletHTLC, WalletSecrets):
         Returns:
             List[Proof]: List of restored proofs
         """
-        # we regenerate the secrets and rs for the given range
-        secrets, rs, derivation_paths = await self.generate_secrets_from_to(
-            from_counter, to_counter
-        )
-        # we don't know the amount but luckily the mint will tell us so we use a dummy amount here
-        amounts_dummy = [1] * len(secrets)
-        # we generate outputs from deterministic secrets and rs
-        regenerated_outputs, _ = self._construct_outputs(amounts_dummy, secrets, rs)
-        # we ask the mint to reissue the promises
-        proofs = await self.restore_promises(
-            outputs=regenerated_outputs,
-            secrets=secrets,
-            rs=rs,
-            derivation_paths=derivation_paths,
-        )
-
-        await set_secret_derivation(
-            db=self.db, keyset_id=self.keyset_id, counter=to_counter + 1
+        (proofs,) = await self.restore_promises_from_ranges(
+            [(from_counter, to_counter)]
         )
         return proofs
 
+    async def restore_promises_from_ranges(
+        self, ranges: List[Tuple[int, int]]
+    ) -> List[List[Proof]]:
+        """Restores promises from several ranges of counters like
+        `restore_promises_from_to`, asking the mint for all of them at once.
+
+        Args:
+            ranges (List[Tuple[int, int]]): (from_counter, to_counter) of each range
+
+        Returns:
+            List[List[Proof]]: restored proofs of each range
+        """
+        regenerated = []
+        for from_counter, to_counter in ranges:
+            # we regenerate the secrets and rs for the given range
+            secrets, rs, derivation_paths = await self.generate_secrets_from_to(
+                from_counter, to_counter
+            )
+            # we don't know the amount but luckily the mint will tell us so we use a dummy amount here
+            amounts_dummy = [1] * len(secrets)
+            # we generate outputs from deterministic secrets and rs
+            outputs, _ = self._construct_outputs(amounts_dummy, secrets, rs)
+            regenerated.append((outputs, secrets, rs, derivation_paths))
+        # we ask the mint to reissue the promises
+        restored = await self.restore_promises_batch([r[0] for r in regenerated])
+
+        proofs_per_range = []
+        for (_, to_counter), regenerated_range, restored_range in zip(
+            ranges, regenerated, restored
+        ):
+            proofs = await self._construct_restored_proofs(
+                *regenerated_range, *restored_range
+            )
+            await set_secret_derivation(
+                db=self.db, keyset_id=self.keyset_id, counter=to_counter + 1
+            )
+            proofs_per_range.append(proofs)
+        return proofs_per_range
+
     async def restore_promises(
         self,
         outputs: List[BlindedMessage],
@@ -1465,6 +1989,20 @@ class Wallet(LedgerAPI, WalletP2PK, WalletHTLC, WalletSecrets):
         """
         # restored_outputs is there so we can match the promises to the secrets and rs
         restored_outputs, restored_promises = await super().restore_promises(outputs)
+        return await self._construct_restored_proofs(
+            outputs, secrets, rs, derivation_paths, restored_outputs, restored_promises
+        )
+
+    async def _construct_restored_proofs(
+        self,
+        outputs: List[BlindedMessage],
+        secrets: List[str],
+        rs: List[PrivateKey],
+        derivation_paths: List[str],
+        restored_outputs: List[BlindedMessage],
+        restored_promises: List[BlindedSignature],
+    ) -> List[Proof]:
+        """Constructs proofs from the promises the mint restored for outputs."""
         # now we need to filter out the secrets and rs that had a match
         matching_indices = [
             idx
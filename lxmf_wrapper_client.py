@@ -4,9 +4,200 @@ import RNS
 import os
 import time
 import LXMF
-import sys
-import random
-import string
+
+from lxmf_codec import (
+    FIELD_CODECS,
+    FIELD_DICTIONARIES,
+    FIELD_ENVELOPE,
+    FIELD_STATUS,
+    FEATURE_BATCH,
+    capabilities,
+    choose_codec,
+    choose_dictionary,
+    choose_schema,
+    decode_batch_response,
+    decode_response,
+    dictionary_ids,
+    encode_batch_request,
+    encode_request,
+)
+from delivery_method import (
+    SESSION,
+    DeliveryLog,
+    choose_delivery_method,
+    content_size,
+    link_is_up,
+)
+from destination_resolver import DestinationResolver, set_result_once
+from keyset_sync import AnnouncedFingerprints
+from request_tracking import PendingRequests, format_req_id
+from url_routing import RoutingTable, all_destinations, is_read_only
+from lxmf_session import (
+    APP_NAME,
+    ASPECT,
+    SESSION_CAPABILITIES,
+    SessionMessage,
+    receive_fields,
+    send_fields,
+    session_destination,
+)
+
+# How long to wait for the path to a proxy's session destination and for
+# the link to come up before falling back to LXMF messages
+SESSION_TIMEOUT = 30
+# After a session could not be opened, don't try again for this long, the
+# proxy probably does not support sessions
+SESSION_RETRY_DELAY = 10 * 60
+# How long to wait for the identity of a proxy we have not heard from yet
+IDENTITY_TIMEOUT = 5 * 60
+# Readiness of a mapped proxy, see LXMFWrapperClient.prewarm()
+RESOLVING = "resolving"
+READY = "ready"
+UNREACHABLE = "unreachable"
+# A request nobody waits for any more is forgotten after this long
+PENDING_REQUEST_DEADLINE = 5 * 60
+
+
+def is_valid_reply(reply):
+    """A reply (LXMFProxyResponse, or the list send_batch returns) that
+    ends a fan-out. Errors of the proxy itself (status 5xx, like a proxy
+    that cannot reach the mint, or 429 from a proxy that throttles us) do
+    not, another proxy may do better."""
+    if isinstance(reply, list):
+        return all(is_valid_reply(response) for response in reply)
+    if isinstance(reply, BaseException):
+        return False
+    return reply.status_code < 500 and reply.status_code != 429
+
+
+def busy_retry_after(reply):
+    """Seconds a busy proxy (503), or one that throttles us (429), asked us
+    to wait before sending the request (or for a batch, all of its
+    requests) again, None if it did not."""
+    if isinstance(reply, list):
+        delays = [busy_retry_after(response) for response in reply]
+        if not delays or None in delays:
+            return None
+        return max(delays)
+    if isinstance(reply, BaseException) or reply.status_code not in (429, 503):
+        return None
+    try:
+        return float(reply.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class ProxyScores:
+    """Smoothed round trip time (seconds from sending a request to getting
+    its reply) of each proxy, keyed by destination hex."""
+
+    def __init__(self, alpha=0.3):
+        # weight of the newest sample
+        self.alpha = alpha
+        self.rtts = {}
+
+    def record(self, destination, rtt):
+        old = self.rtts.get(destination)
+        if old is None:
+            self.rtts[destination] = rtt
+        else:
+            self.rtts[destination] = old + self.alpha * (rtt - old)
+
+    def record_at_least(self, destination, rtt):
+        """The proxy took longer than rtt, we stopped waiting before its
+        reply came."""
+        old = self.rtts.get(destination)
+        if old is None or old < rtt:
+            self.record(destination, rtt)
+
+    def get(self, destination):
+        return self.rtts.get(destination)
+
+
+class ProxySession:
+    """A RNS.Link to the session destination of a proxy, kept open to send
+    requests and get replies without setting up a link for each of them.
+    See lxmf_session.py."""
+
+    def __init__(self, lxmf_wrapper_client, destination, identity):
+        self.lxmf_wrapper_client = lxmf_wrapper_client
+        # LXMF address of the proxy (hex), replies are handled as if they
+        # came from there
+        self.destination = destination
+        self.identity = identity
+        self.link = None
+        self.closed = False
+        self.opened_at = time.time()
+        self.event_loop = asyncio.get_running_loop()
+        self.established = self.event_loop.create_future()
+
+    async def open(self):
+        """Opens the link. Returns True once it is established, False if
+        it could not be."""
+        destination = session_destination(self.identity, RNS.Destination.OUT)
+        if not await self.lxmf_wrapper_client.session_resolver.find_path(
+            destination.hash, SESSION_TIMEOUT
+        ):
+            print(f"No path to the session destination of {self.destination}")
+            self.closed = True
+            set_result_once(self.established, False)
+            return False
+        self.link = RNS.Link(
+            destination,
+            established_callback=self.link_established,
+            closed_callback=self.link_closed,
+        )
+        receive_fields(self.link, self.fields_received)
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(self.established), SESSION_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            print(f"Timed out opening session to {self.destination}")
+            self.link.teardown()
+            return False
+
+    def link_established(self, link):
+        print(f"Session to {self.destination} established")
+        # the proxy knows us by our LXMF address, even across sessions
+        link.identify(self.lxmf_wrapper_client.ID)
+        self.event_loop.call_soon_threadsafe(set_result_once, self.established, True)
+
+    def link_closed(self, link):
+        print(f"Session to {self.destination} closed")
+        self.closed = True
+        self.event_loop.call_soon_threadsafe(set_result_once, self.established, False)
+        # requests sent over this session will not get a reply, they are
+        # sent again, over a new session or as LXMF messages
+        for request in self.lxmf_wrapper_client.pending.values():
+            if request.session is self and request.failed_callback is not None:
+                request.failed_callback(
+                    SessionMessage(
+                        {"req_id": request.req_id}, bytes.fromhex(self.destination)
+                    )
+                )
+
+    def fields_received(self, link, fields):
+        self.lxmf_wrapper_client.receive_handler(
+            SessionMessage(fields, bytes.fromhex(self.destination))
+        )
+
+    def send(self, fields):
+        send_fields(self.link, fields)
+
+
+class PendingRequest:
+    """What LXMFWrapperClient keeps about a request until its reply comes."""
+
+    def __init__(self, req_id, reply_callback, source_hash, failed_callback, session):
+        self.req_id = req_id
+        self.reply_callback = reply_callback
+        # replies are only accepted from the destination the request went to
+        self.source_hash = source_hash
+        # only for requests sent over a session, LXMF calls the failed
+        # callback of a LXMessage itself
+        self.failed_callback = failed_callback
+        self.session = session
 
 
 class LXMFWrapperClient:
@@ -18,9 +209,8 @@ class LXMFWrapperClient:
             cls._instance = super(LXMFWrapperClient, cls).__new__(cls)
         return cls._instance
 
-    # Generate a 4-byte ASCII string
-    def random_id(self):
-        return "".join(random.choices(string.ascii_letters + string.digits, k=4))
+    def new_request_id(self):
+        return self.pending.new_id()
 
     def receive_handler(self, lxm):
         fields = lxm.fields
@@ -28,22 +218,166 @@ class LXMFWrapperClient:
         if req_id is None:
             print("Received reply with req_id not set")
             return
-        if req_id not in self.reply_callbacks:
-            print(f"Received reply with unknown req_id {req_id}")
+        request = self.pending.get(req_id)
+        if request is None:
+            print(f"Received reply with unknown req_id {format_req_id(req_id)}")
             return
 
-        reply_callback, destination_hash = self.reply_callbacks[req_id]
         # Only call callbacks that come from the right source for the req_id
         # source_hash is signed, so it could not have come from anyone else
-        if lxm.source_hash != destination_hash:
+        if lxm.source_hash != request.source_hash:
             print(
-                f"Received reply for {req_id} from wrong source. Was expecting {lxm.source_hash}, got {destination_hash}"
+                f"Received reply for {format_req_id(req_id)} from wrong source. Was expecting {request.source_hash}, got {lxm.source_hash}"
             )
             return
 
-        del self.reply_callbacks[req_id]
-        print(f"Calling reply_callback for {req_id}")
-        reply_callback(req_id, lxm)
+        # The proxy tells us which envelope codecs it understands, from now
+        # on we can talk to it in the compact format
+        codecs = fields.pop(FIELD_CODECS, None)
+        if codecs is not None:
+            self.peer_codecs[lxm.source_hash.hex()] = codecs
+            self.peer_dictionaries[lxm.source_hash.hex()] = fields.pop(
+                FIELD_DICTIONARIES, []
+            )
+
+        if self.pending.pop(req_id) is None:
+            # a retransmission was answered too, the first reply won
+            return
+        print(f"Calling reply_callback for {format_req_id(req_id)}")
+        request.reply_callback(req_id, lxm)
+
+    def track_request(
+        self,
+        req_id,
+        reply_callback,
+        source_hash,
+        deadline,
+        failed_callback=None,
+        session=None,
+    ):
+        if deadline is None:
+            deadline = time.time() + PENDING_REQUEST_DEADLINE
+        self.pending.add(
+            req_id,
+            PendingRequest(
+                req_id, reply_callback, source_hash, failed_callback, session
+            ),
+            deadline,
+        )
+
+    def forget_request(self, req_id):
+        self.pending.pop(req_id)
+
+    async def get_session(self, destination):
+        """Returns an established session to the proxy with LXMF address
+        destination (hex), opens one if there is none yet. Returns None if
+        it cannot be opened, the caller then sends LXMF messages. Sessions
+        to different proxies are opened concurrently, callers wanting a
+        session that is being opened wait for that one."""
+        session = self.sessions.get(destination)
+        if (
+            session is not None
+            and session.established.done()
+            and not session.established.result()
+            and time.time() - session.opened_at < SESSION_RETRY_DELAY
+        ):
+            return None
+        if session is None or session.closed:
+            opening = self.session_openings.get(destination)
+            if opening is None:
+                opening = asyncio.ensure_future(self.open_session(destination))
+                self.session_openings[destination] = opening
+            session = await asyncio.shield(opening)
+            if session is None:
+                return None
+        if not await session.established:
+            return None
+        return session
+
+    async def open_session(self, destination):
+        """Opens a new session to destination (hex), returns it or None."""
+        try:
+            identity = await self.recall_identity(bytes.fromhex(destination))
+            if identity is None:
+                return None
+            session = ProxySession(self, destination, identity)
+            self.sessions[destination] = session
+            if not await session.open():
+                return None
+            return session
+        finally:
+            del self.session_openings[destination]
+
+    async def send_session_message(
+        self,
+        session,
+        fields,
+        failed_callback,
+        reply_callback,
+        req_id=None,
+        deadline=None,
+    ):
+        if req_id is None:
+            req_id = self.new_request_id()
+        fields["req_id"] = req_id
+        if reply_callback is not None:
+            self.track_request(
+                req_id,
+                reply_callback,
+                bytes.fromhex(session.destination),
+                deadline,
+                failed_callback,
+                session,
+            )
+        self.delivery_log.record(req_id, content_size("", "", fields), SESSION, True)
+        session.send(fields)
+
+    async def recall_identity(self, destination_bytes):
+        destination = await self.resolve_destination(destination_bytes.hex())
+        if destination is None:
+            return None
+        return destination.identity
+
+    async def resolve_destination(self, destination):
+        """Returns the LXMF RNS.Destination of destination (hex), waiting
+        for its identity if needed, and updates its readiness."""
+        lxmf_destination = await self.resolver.resolve(
+            bytes.fromhex(destination), IDENTITY_TIMEOUT
+        )
+        self.readiness[destination] = READY if lxmf_destination else UNREACHABLE
+        return lxmf_destination
+
+    def prewarm(self, destinations):
+        """Requests paths to and identities of destinations (hex) in the
+        background, so the first request to each of them does not wait for
+        that. Destinations already being prewarmed are skipped. Must be
+        called from the event loop."""
+        for destination in destinations:
+            if destination in self.prewarm_tasks:
+                continue
+            self.readiness.setdefault(destination, RESOLVING)
+            self.prewarm_tasks[destination] = asyncio.create_task(
+                self.resolve_destination(destination)
+            )
+
+    def rank_destinations(self, destinations):
+        """Returns destinations sorted best first: the fastest recently,
+        proxies we have not measured yet before slower ones, and unreachable
+        ones last."""
+        if len(destinations) == 1:
+            return list(destinations)
+        return sorted(
+            destinations,
+            key=lambda destination: (
+                self.readiness.get(destination) == UNREACHABLE,
+                self.rtt_scores.get(destination) or 0,
+            ),
+        )
+
+    def destination_readiness(self, destination):
+        """RESOLVING, READY or UNREACHABLE for a destination (hex) that was
+        prewarmed or sent to, None for others."""
+        return self.readiness.get(destination)
 
     async def send_lxmf_message(
         self,
@@ -54,48 +388,29 @@ class LXMFWrapperClient:
         failed_callback,
         reply_callback,
         req_id=None,
+        deadline=None,
     ):
-        # Convert string to bytes below if you pass as a string
-        destination_bytes = bytes.fromhex(destination)
-
-        # Check to see if RNS knows the identity
-        destination_identity = RNS.Identity.recall(destination_bytes)
-
-        # If it doesn't know the identity:
-        if destination_identity is None:
-            basetime = time.time()
-            # Request it
-            RNS.Transport.request_path(destination_bytes)
-            # And wait until it arrives; timeout in 300s
-            print(
-                f"Don't have identity for {destination}, waiting for it to arrive for 300s"
-            )
-            while destination_identity is None and (time.time() - basetime) < 300:
-                destination_identity = RNS.Identity.recall(None)
-                await asyncio.sleep(1)
-        if destination_identity is None:
-            print("Error: Cannot recall identity")
-            sys.exit(1)
-
-        lxmf_destination = RNS.Destination(
-            destination_identity,
-            RNS.Destination.OUT,
-            RNS.Destination.SINGLE,
-            "lxmf",
-            "delivery",
-        )
+        lxmf_destination = await self.resolve_destination(destination)
+        if lxmf_destination is None:
+            raise Exception(f"Cannot recall identity of {destination}")
 
         if req_id is None:
-            req_id = self.random_id()
+            req_id = self.new_request_id()
         fields["req_id"] = req_id
 
+        # Small requests go as a single packet, unless a link is up anyway
+        size = content_size("", content, fields)
+        link_up = link_is_up(self.lxm_router, lxmf_destination.hash)
+        desired_method = choose_delivery_method(size, link_up)
+        self.delivery_log.record(req_id, size, desired_method, link_up)
+
         # Create the lxm object
         lxm = LXMF.LXMessage(
             lxmf_destination,
             self.local_lxmf_destination,
             content,
             fields=fields,
-            desired_method=LXMF.LXMessage.DIRECT,
+            desired_method=desired_method,
         )
 
         if delivery_callback is not None:
@@ -103,10 +418,7 @@ class LXMFWrapperClient:
         if failed_callback is not None:
             lxm.register_failed_callback(failed_callback)
         if reply_callback is not None:
-            self.reply_callbacks[fields["req_id"]] = (
-                reply_callback,
-                lxmf_destination.hash,
-            )
+            self.track_request(req_id, reply_callback, lxmf_destination.hash, deadline)
 
         # Send the message through the router
         self.lxm_router.handle_outbound(lxm)
@@ -132,14 +444,38 @@ class LXMFWrapperClient:
         self.lxm_router.register_delivery_callback(
             lambda lxm: self.receive_handler(lxm)
         )
+        # proxies announce a fingerprint of their mint's keysets
+        RNS.Transport.register_announce_handler(self.announced_fingerprints)
+        RNS.Transport.register_announce_handler(self.resolver)
+        RNS.Transport.register_announce_handler(self.session_resolver)
         self.local_lxmf_destination = self.lxm_router.register_delivery_identity(
             self.ID, display_name="LXMFProxy"
         )
         self.local_lxmf_destination.announce()
 
     def __init__(self):
-        if (not hasattr(self, "reply_callbacks")) or (self.reply_callbacks is None):
-            self.reply_callbacks = {}
+        if (not hasattr(self, "pending")) or (self.pending is None):
+            # requests waiting for a reply, len(self.pending) is how many
+            self.pending = PendingRequests()
+            # envelope codecs supported by each proxy, keyed by destination hex
+            self.peer_codecs = {}
+            # zstd dictionary ids each proxy has, keyed by destination hex
+            self.peer_dictionaries = {}
+            self.announced_fingerprints = AnnouncedFingerprints()
+            # LXMF destinations of the proxies, shared by all requests
+            self.resolver = DestinationResolver("lxmf", "delivery")
+            # destination hex -> RESOLVING, READY or UNREACHABLE
+            self.readiness = {}
+            self.prewarm_tasks = {}
+            self.rtt_scores = ProxyScores()
+            # delivery method chosen for each request
+            self.delivery_log = DeliveryLog()
+            # open sessions to proxies, keyed by destination hex
+            self.sessions = {}
+            # destination hex -> task opening a session to it
+            self.session_openings = {}
+            # session destinations of the proxies, to wait for their paths
+            self.session_resolver = DestinationResolver(APP_NAME, ASPECT)
             self.create_lxmf_proxy()
 
 
@@ -150,26 +486,261 @@ class LXMFProxy:
         httpx=None,
         httpx_allowed=False,
         mappings=None,
+        session_mode=False,
+        request_timeout=60,
+        max_attempts=3,
+        request_backoff=2,
+        request_deadline=300,
+        routes=None,
+        hedge_delay=None,
     ):
         self.mappings = mappings
         if self.mappings is None:
             self.mappings = {}
+        # RoutingTable of the mappings, proxies with the same mappings can
+        # share one
+        self.routes = routes
+        if self.routes is None:
+            self.routes = RoutingTable(self.mappings)
         self.lxmf_wrapper_client = lxmf_wrapper_client
         self.httpx = httpx
         self.httpx_allowed = httpx_allowed
-        self.futures = {}  # Dictionary to store futures mapped by req_id
+        # keep a link open to each proxy instead of sending LXMF messages
+        self.session_mode = session_mode
+        # seconds to wait for the reply to the first attempt, every further
+        # attempt waits request_backoff times longer, a request gives up
+        # after max_attempts or request_deadline seconds
+        self.request_timeout = request_timeout
+        self.max_attempts = max_attempts
+        self.request_backoff = request_backoff
+        self.request_deadline = request_deadline
+        # read-only requests to a mint with several proxies go to all of
+        # them at once, or with hedge_delay set, to the next one every
+        # hedge_delay seconds until a reply comes
+        self.hedge_delay = hedge_delay
         self.event_loop = asyncio.get_running_loop()
+        # find the mapped proxies before the first request needs them
+        self.lxmf_wrapper_client.prewarm(all_destinations(self.mappings))
+
+    def set_mappings(self, mappings, routes=None):
+        """Swaps in new mappings. Requests that were already sent keep going
+        to the destination they were sent to."""
+        if routes is None:
+            routes = RoutingTable(mappings)
+        self.routes = routes
+        self.mappings = mappings
+
+    def get_destinations_for_url(self, url):
+        """Returns (list of the proxies of the mint at url, best first, url
+        relative to the mapping), or (None, url) if url is not mapped."""
+        destinations, new_url = self.routes.route(url)
+        if destinations is None:
+            return (None, new_url)
+        return (self.lxmf_wrapper_client.rank_destinations(destinations), new_url)
 
     def get_destination_for_url(self, url):
-        destination = None
-        new_url = url
-        for map_url in self.mappings:
-            if url.startswith(map_url):
-                destination = self.mappings[map_url]
-                new_url = url.replace(map_url, "")
-                break
+        """Like get_destinations_for_url, but only the best proxy."""
+        destinations, new_url = self.get_destinations_for_url(url)
+        if destinations is None:
+            return (None, new_url)
+        return (destinations[0], new_url)
+
+    def destination_ready(self, url):
+        """Readiness (RESOLVING, READY or UNREACHABLE) of the proxy url maps
+        to, None if url is not mapped."""
+        destination, _ = self.get_destination_for_url(url)
+        if destination is None:
+            return None
+        return self.lxmf_wrapper_client.destination_readiness(destination)
+
+    def announced_fingerprint(self, url):
+        """Keyset fingerprint recently announced by a proxy url maps to,
+        None if url is not mapped or we have not heard one."""
+        destinations, _ = self.get_destinations_for_url(url)
+        for destination in destinations or []:
+            fingerprint = self.lxmf_wrapper_client.announced_fingerprints.get(
+                destination
+            )
+            if fingerprint is not None:
+                return fingerprint
+        return None
+
+    async def first_reply(self, destinations, run):
+        """Awaits run(destination) for destinations (best first) and returns
+        the first valid reply, see is_valid_reply(). They are all started at
+        once, or with hedge_delay set, the next one whenever hedge_delay
+        seconds pass without a reply or one of them fails. The others are
+        cancelled. If no reply is valid, returns the last reply or raises
+        the last exception."""
+        remaining = list(destinations)
+        pending = set()
+        reply = None
+        error = None
+        try:
+            while remaining or pending:
+                if self.hedge_delay is None:
+                    starting, remaining = remaining, []
+                else:
+                    starting, remaining = remaining[:1], remaining[1:]
+                for destination in starting:
+                    pending.add(asyncio.create_task(run(destination)))
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=self.hedge_delay if remaining else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif is_valid_reply(task.result()):
+                        return task.result()
+                    else:
+                        reply = task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+        if reply is not None:
+            return reply
+        raise error
+
+    def request_fields(self):
+        """Fields every request carries, they tell the proxy what we can
+        decode."""
+        fields = {}
+        fields[FIELD_CODECS] = capabilities()
+        if dictionary_ids():
+            fields[FIELD_DICTIONARIES] = dictionary_ids()
+        return fields
+
+    async def get_session(self, destination):
+        """Returns the session to destination in session mode, None if not
+        in session mode or the session cannot be opened."""
+        if not self.session_mode:
+            return None
+        return await self.lxmf_wrapper_client.get_session(destination)
+
+    def peer_capabilities(self, destination, session=None):
+        """What the proxy told us it can decode, in a reply or else in its
+        announce. Before it told us anything, a proxy we have a session with
+        can decode at least SESSION_CAPABILITIES."""
+        peer_codecs = self.lxmf_wrapper_client.peer_codecs.get(destination)
+        if peer_codecs is None:
+            peer_codecs = self.lxmf_wrapper_client.announced_fingerprints.codecs_of(
+                destination
+            )
+        if peer_codecs is None and session is not None:
+            return SESSION_CAPABILITIES
+        return peer_codecs
+
+    async def send_request(
+        self, destination, content, fields, description, session=None, req_id=None
+    ):
+        """Sends a request message to destination, over session if given,
+        and waits for the reply. If no reply comes within the attempt's
+        timeout, or delivery fails, the request is sent again with the same
+        req_id and a timeout backoff times longer, until max_attempts or the
+        deadline is reached. A new req_id is used unless one is given.
+
+        Returns a tuple of (reply LXMessage or SessionMessage, attempts,
+        seconds it took). Raises an exception if there was no reply."""
+
+        def describe_request(lxm):
+            req_id = ""
+            if "req_id" in lxm.fields:
+                req_id = format_req_id(lxm.fields["req_id"])
+            return f"{description} ID {req_id}"
+
+        def delivery_callback(lxm):
+            print(f"Delivered: {describe_request(lxm)}")
+
+        future = self.event_loop.create_future()
+
+        def reply_callback(req_id, lxm):
+            try:
+                self.event_loop.call_soon_threadsafe(set_result_once, future, lxm)
+            except Exception as e:
+                print(e)
+
+        if req_id is None:
+            req_id = self.lxmf_wrapper_client.new_request_id()
+        started = time.time()
+        deadline = started + self.request_deadline
+        timeout = self.request_timeout
+        attempt = 0
+        try:
+            while attempt < self.max_attempts and time.time() < deadline:
+                attempt += 1
+                # LXMF calls this from its own thread when it gives up
+                # delivering this attempt
+                attempt_failed = self.event_loop.create_future()
+
+                def failed_callback(lxm, attempt_failed=attempt_failed):
+                    print(f"Failed: {describe_request(lxm)}")
+                    self.event_loop.call_soon_threadsafe(
+                        set_result_once, attempt_failed, True
+                    )
+
+                if session is not None and session.closed:
+                    session = await self.get_session(destination)
+                if session is not None:
+                    await self.lxmf_wrapper_client.send_session_message(
+                        session,
+                        fields,
+                        failed_callback,
+                        reply_callback,
+                        req_id=req_id,
+                        deadline=deadline,
+                    )
+                else:
+                    await self.lxmf_wrapper_client.send_lxmf_message(
+                        destination,
+                        content,
+                        fields,
+                        delivery_callback,
+                        failed_callback,
+                        reply_callback,
+                        req_id=req_id,
+                        deadline=deadline,
+                    )
+                await asyncio.wait(
+                    [future, attempt_failed],
+                    timeout=max(0, min(timeout, deadline - time.time())),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if future.done():
+                    break
+                if attempt_failed.done():
+                    print(
+                        f"{description} ID {format_req_id(req_id)}: attempt {attempt} failed"
+                    )
+                else:
+                    print(
+                        f"{description} ID {format_req_id(req_id)}: no reply to attempt {attempt}"
+                        f" after {timeout:.0f}s"
+                    )
+                timeout *= self.request_backoff
+        except asyncio.CancelledError:
+            # another proxy replied first
+            self.lxmf_wrapper_client.rtt_scores.record_at_least(
+                destination, time.time() - started
+            )
+            raise
+        finally:
+            self.lxmf_wrapper_client.forget_request(req_id)
 
-        return (destination, new_url)
+        elapsed = time.time() - started
+        self.lxmf_wrapper_client.rtt_scores.record(destination, elapsed)
+        if not future.done():
+            raise Exception(
+                f"Request failed: {description} ID {format_req_id(req_id)}, no reply after"
+                f" {attempt} attempts in {elapsed:.1f}s"
+            )
+        lxm_reply = future.result()
+        print(
+            f"{description} ID {format_req_id(req_id)}: reply after {attempt} attempts"
+            f" in {elapsed:.1f}s, {len(self.lxmf_wrapper_client.pending)} pending"
+        )
+        return (lxm_reply, attempt, elapsed)
 
     async def handle_request(
         self,
@@ -183,8 +754,8 @@ class LXMFProxy:
         params=None,
         **kwargs,
     ):
-        destination, new_url = self.get_destination_for_url(url)
-        if destination is None:
+        destinations, new_url = self.get_destinations_for_url(url)
+        if destinations is None:
             if self.httpx_allowed and self.httpx is not None:
                 return await self.httpx.get(
                     url, params=params, headers=headers, cookies=cookies, **kwargs
@@ -193,8 +764,60 @@ class LXMFProxy:
                 raise Exception(
                     f"URL {url} not found in mappings and http(s) is disabled"
                 )
+
+        def request_to(destination):
+            return self.request_to(
+                destination,
+                method,
+                new_url,
+                data=data,
+                json=json,
+                headers=headers,
+                cookies=cookies,
+                params=params,
+            )
+
+        # anything that changes the mint's state goes to one proxy only
+        if len(destinations) > 1 and is_read_only(new_url):
+            return await self.first_reply(destinations, request_to)
+        return await request_to(destinations[0])
+
+    async def request_to(
+        self,
+        destination,
+        method,
+        new_url,
+        *,
+        data=None,
+        json=None,
+        headers=None,
+        cookies=None,
+        params=None,
+    ):
+        """Sends a request for new_url (relative to the mapping) to the proxy
+        destination and returns its LXMFProxyResponse."""
+        session = await self.get_session(destination)
+        fields = self.request_fields()
+        peer_codecs = self.peer_capabilities(destination, session)
+        codec = choose_codec(peer_codecs)
+        if codec is not None:
+            # proxy already told us it speaks the envelope format
+            fields[FIELD_ENVELOPE] = encode_request(
+                method,
+                new_url,
+                codec,
+                choose_dictionary(
+                    self.lxmf_wrapper_client.peer_dictionaries.get(destination)
+                ),
+                params=params,
+                headers=headers,
+                cookies=cookies,
+                data=data,
+                json=json,
+                schema=choose_schema(peer_codecs),
+            )
+            new_url = ""
         else:
-            fields = {}
             fields["method"] = method
             if data is not None:
                 fields["data"] = data
@@ -207,63 +830,164 @@ class LXMFProxy:
             if cookies is not None:
                 fields["cookies"] = cookies
 
-            def describe_request(lxm):
-                req_id = ""
-                method = ""
-                if "req_id" in lxm.fields:
-                    req_id = lxm.fields["req_id"]
-                if "method" in lxm.fields:
-                    method = lxm.fields["method"]
-                return f"{method} request ID {req_id}"
-
-            def delivery_callback(lxm):
-                print(f"Delivered: {describe_request(lxm)}")
-
-            def failed_callback(lxm):
-                request_description = describe_request(lxm)
-                print(f"Failed: {request_description}")
-                if "req_id" in lxm.fields:
-                    req_id = lxm.fields["req_id"]
-                    future = self.futures.get(req_id)
-                    if future and not future.done():
-                        del self.futures[req_id]
-                        future.set_exception(
-                            Exception(f"Request failed: {request_description}")
-                        )
+        async def send(req_id):
+            lxm_reply, attempts, elapsed = await self.send_request(
+                destination, new_url, fields, f"{method} request", session, req_id
+            )
+            return LXMFProxyResponse(lxm_reply, attempts=attempts, elapsed=elapsed)
+
+        return await self.retry_when_busy(send)
+
+    async def retry_when_busy(self, send):
+        """Awaits send(req_id) and returns its reply. While the proxy replies
+        that it is busy, waits as long as it asks and sends again, until
+        max_attempts or request_deadline. Every send has the same req_id, if
+        the proxy did run the request, it replies from its reply cache
+        instead of running it again."""
+        req_id = self.lxmf_wrapper_client.new_request_id()
+        started = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            reply = await send(req_id)
+            retry_after = busy_retry_after(reply)
+            if (
+                retry_after is None
+                or attempt >= self.max_attempts
+                or time.time() + retry_after - started > self.request_deadline
+            ):
+                return reply
+            print(f"Proxy is busy, sending again in {retry_after:g}s")
+            await asyncio.sleep(retry_after)
+
+    async def send_batch(self, destination, requests, session=None):
+        """Sends requests (a list of (method, path, kwargs)) to destination in
+        one message. Returns a list of LXMFProxyResponse in the same order."""
+        peer_codecs = self.peer_capabilities(destination, session)
+        fields = self.request_fields()
+        fields[FIELD_ENVELOPE] = encode_batch_request(
+            [
+                dict(method=method, path=path, **kwargs)
+                for method, path, kwargs in requests
+            ],
+            choose_codec(peer_codecs),
+            choose_dictionary(
+                self.lxmf_wrapper_client.peer_dictionaries.get(destination)
+            ),
+            choose_schema(peer_codecs),
+        )
+        description = f"batch of {len(requests)} requests"
+
+        async def send(req_id):
+            lxm_reply, attempts, elapsed = await self.send_request(
+                destination, "", fields, description, session, req_id
+            )
+            responses = []
+            for (method, path, _), response in zip(
+                requests, decode_batch_response(lxm_reply.fields[FIELD_ENVELOPE])
+            ):
+                if response is None:
+                    responses.append(Exception(f"Request failed: {method} {path}"))
                 else:
-                    raise Exception(f"Request failed: {request_description}")
-
-            def failed_callback(lxm):
-                request_description = describe_request(lxm)
-                print(f"Failed: {request_description}")
-                raise Exception(f"Request failed {request_description}")
-
-            def reply_callback(req_id, lxm):
-                response = lxm
-                future = self.futures.pop(req_id, None)
-                if future and not future.done():
-                    try:
-                        self.event_loop.call_soon_threadsafe(
-                            future.set_result, response
+                    responses.append(
+                        LXMFProxyResponse(
+                            lxm_reply, response, attempts=attempts, elapsed=elapsed
                         )
-                    except Exception as e:
-                        print(e)
+                    )
+            return responses
 
-            req_id = self.lxmf_wrapper_client.random_id()
-            future = asyncio.Future()
-            self.futures[req_id] = future
-            await self.lxmf_wrapper_client.send_lxmf_message(
-                destination,
-                new_url,
-                fields,
-                delivery_callback,
-                failed_callback,
-                reply_callback,
-                req_id=req_id,
+        return await self.retry_when_busy(send)
+
+    async def send_batch_to_mint(self, destinations, requests, session=None):
+        """Sends a batch to the best of destinations (proxies of one mint,
+        best first, session is the one to the best), or to all of them if
+        all requests in it are read-only."""
+        if len(destinations) == 1 or not all(
+            is_read_only(path) for _, path, _ in requests
+        ):
+            return await self.send_batch(destinations[0], requests, session)
+
+        async def send_batch(destination):
+            if destination != destinations[0]:
+                return await self.send_batch(
+                    destination, requests, await self.get_session(destination)
+                )
+            return await self.send_batch(destination, requests, session)
+
+        return await self.first_reply(destinations, send_batch)
+
+    async def gather_requests(self, requests, return_exceptions=False):
+        """Sends several requests at once and returns their responses in the
+        same order, like asyncio.gather. Each request is a tuple (method,
+        url) or (method, url, kwargs) with the keyword arguments of
+        handle_request. Requests for the same proxy go in one message if
+        the proxy supports batches, the others are sent concurrently. A
+        batch of read-only requests goes to all the proxies of the mint,
+        like a single one does in handle_request.
+
+        With return_exceptions, failed requests are returned as exceptions
+        instead of raising the first one."""
+        batches = {}  # destination -> [(index, (method, path, kwargs))]
+        singles = []  # [(index, coroutine)]
+        sessions = {}  # destination -> session or None
+        # best destination -> all proxies of its mint, best first
+        mint_destinations = {}
+        for index, request in enumerate(requests):
+            method, url = request[0], request[1]
+            kwargs = request[2] if len(request) > 2 else {}
+            destinations, new_url = self.get_destinations_for_url(url)
+            destination = None
+            if destinations is not None:
+                destination = destinations[0]
+                mint_destinations.setdefault(destination, destinations)
+            if destination is not None and destination not in sessions:
+                sessions[destination] = await self.get_session(destination)
+            peer_codecs = (
+                self.peer_capabilities(destination, sessions.get(destination)) or []
             )
-            lxm_reply = await future
-            print(lxm_reply)
-            return LXMFProxyResponse(lxm_reply)
+            if destination is not None and FEATURE_BATCH in peer_codecs:
+                batches.setdefault(destination, []).append(
+                    (index, (method, new_url, kwargs))
+                )
+            else:
+                singles.append((index, self.handle_request(method, url, **kwargs)))
+
+        # a batch of one is sent as a plain request
+        for destination, batch in list(batches.items()):
+            if len(batch) == 1:
+                index, (method, _, kwargs) = batch[0]
+                singles.append(
+                    (index, self.handle_request(method, requests[index][1], **kwargs))
+                )
+                del batches[destination]
+
+        batch_results = await asyncio.gather(
+            *(
+                self.send_batch_to_mint(
+                    mint_destinations[destination],
+                    [request for _, request in batch],
+                    sessions[destination],
+                )
+                for destination, batch in batches.items()
+            ),
+            *(coroutine for _, coroutine in singles),
+            return_exceptions=True,
+        )
+
+        results = [None] * len(requests)
+        for batch, result in zip(batches.values(), batch_results):
+            for position, (index, _) in enumerate(batch):
+                results[index] = (
+                    result if isinstance(result, Exception) else result[position]
+                )
+        for (index, _), result in zip(singles, batch_results[len(batches) :]):
+            results[index] = result
+
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+        return results
 
     async def get(self, url, *, params=None, headers=None, cookies=None, **kwargs):
         return await self.handle_request(
@@ -280,15 +1004,46 @@ class LXMFProxy:
 
 class LXMFProxyResponse:
 
-    def __init__(self, lxm):
+    def __init__(self, lxm, response=None, attempts=1, elapsed=0.0):
+        """response is the decoded (status_code, body, is_json, headers) of
+        a reply in a batch, otherwise the reply is read from lxm. attempts
+        and elapsed are how many times the request was sent and how many
+        seconds it took to get the reply."""
         self.lxm = lxm
-        self.content = lxm.content
+        self.attempts = attempts
+        self.elapsed = elapsed
+        # proxies leave the status out of replies without the envelope when
+        # it is 200, older ones always do
+        self.status_code = lxm.fields.get(FIELD_STATUS, 200)
+        # the headers of error replies the proxy passes on, by lowercase name
+        self.headers = {}
+        self._body = None
+        if response is None and FIELD_ENVELOPE in lxm.fields:
+            response = decode_response(lxm.fields[FIELD_ENVELOPE])
+        if response is not None:
+            self.status_code, self._body, is_json, self.headers = response
+            if is_json:
+                self.content = json.dumps(self._body).encode("utf-8")
+            else:
+                self.content = self._body.encode("utf-8")
+                self._body = None
+        else:
+            self.content = lxm.content
 
     def json(self):
+        if self._body is not None:
+            return self._body
         return json.loads(self.text())
 
     def text(self):
         return self.content
 
     def raise_for_status(self):
-        pass
+        """Raises an exception if the mint replied with an error (status 4xx
+        or 5xx), like httpx.Response.raise_for_status."""
+        if self.status_code < 400:
+            return
+        text = self.text()
+        if isinstance(text, bytes):
+            text = text.decode("utf-8", "replace")
+        raise Exception(f"Mint replied with status {self.status_code}: {text}")
@@ -18,6 +18,7 @@ from kivy.uix.textinput import TextInput
 from kivy.uix.popup import Popup
 
 from lxmf_wallet.wallet import Wallet as Wallet
+from lxmf_wrapper_client import READY, RESOLVING, UNREACHABLE
 
 from loguru import logger
 
@@ -44,6 +45,15 @@ from cashu.wallet.helpers import (
 walletname = "wallet"
 wallet = None
 
+# How often the status label shows if the mint's proxy is reachable while
+# the mint loads
+READINESS_CHECK_INTERVAL = 1
+READINESS_TEXTS = {
+    RESOLVING: "Looking for the mint's proxy...",
+    READY: "Mint's proxy found, loading mint...",
+    UNREACHABLE: "Mint's proxy unreachable, still trying...",
+}
+
 
 # https://github.com/pallets/click/issues/85#issuecomment-503464628
 def coro(f):
@@ -69,12 +79,37 @@ async def redeem_TokenV3_multimint(wallet: Wallet, token: TokenV3):
 
         keysets = mint_wallet._get_proofs_keysets(t.proofs)
         logger.debug(f"Keysets in tokens: {keysets}")
+        # keysets we know are in the database, the mint is asked about its
+        # current ones in the background, we only wait for that if the token
+        # has keysets we do not know
+        from_cache = await mint_wallet.load_mint_offline_first()
+        if from_cache and not set(keysets) <= set(mint_wallet.keysets):
+            # the refresh loads the keysets we do not know yet
+            if not await mint_wallet.mint_refresh_task:
+                raise Exception(
+                    f"Could not load the keysets of the token from {t.mint}"
+                )
         # loop over all keysets
         for keyset in set(keysets):
-            await mint_wallet.load_mint()
             # redeem proofs of this keyset
             redeem_proofs = [p for p in t.proofs if p.id == keyset]
-            _, _ = await mint_wallet.redeem(redeem_proofs)
+            keyset_id = mint_wallet.keyset_id
+            try:
+                _, _ = await mint_wallet.redeem(redeem_proofs)
+            except Exception as e:
+                # the outputs were for the cached keyset, if the mint has
+                # switched to another one since, try once more with it
+                if (
+                    not from_cache
+                    or not await mint_wallet.mint_refresh_task
+                    or mint_wallet.keyset_id == keyset_id
+                ):
+                    raise
+                logger.warning(
+                    f"Receiving with keyset {keyset_id} failed, retrying with"
+                    f" {mint_wallet.keyset_id}: {e}"
+                )
+                _, _ = await mint_wallet.redeem(redeem_proofs)
             print(f"Received {sum_proofs(redeem_proofs)} sats")
 
 
@@ -603,13 +638,39 @@ class MainWindow(BoxLayout):
         await init_wallet(wallet, load_proofs=True)
         await self.update_balance()
         self.status_label.text = "Wallet initialized, loading mint..."
+        readiness_task = asyncio.create_task(self.show_mint_readiness())
         try:
-            await wallet.load_mint()
+            from_cache = await wallet.load_mint_offline_first()
         except Exception as e:
             self.status_label.text = f"Error while loading mint: {e}"
             logger.exception(e)
             raise e
+        finally:
+            readiness_task.cancel()
         self.status_label.text = "All ready !"
+        if from_cache:
+            asyncio.create_task(self.wait_for_mint_refresh())
+
+    async def wait_for_mint_refresh(self):
+        refreshed = await wallet.mint_refresh_task
+        if refreshed:
+            logger.debug("Mint keysets refreshed")
+        else:
+            if await wallet.mint_readiness() == UNREACHABLE:
+                self.status_label.text = (
+                    "Mint's proxy unreachable, using cached keysets..."
+                )
+            else:
+                self.status_label.text = "Mint unreachable, using cached keysets..."
+
+    async def show_mint_readiness(self):
+        """Shows whether the mint's proxy is reachable until cancelled."""
+        while True:
+            readiness = await wallet.mint_readiness()
+            if readiness is None:
+                return
+            self.status_label.text = READINESS_TEXTS[readiness]
+            await asyncio.sleep(READINESS_CHECK_INTERVAL)
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
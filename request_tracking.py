@@ -0,0 +1,82 @@
+"""Request ids and the table of requests waiting for a reply."""
+
+import heapq
+import os
+import struct
+import time
+
+
+def format_req_id(req_id):
+    """Printable form of a req_id. Ids from PendingRequests are bytes,
+    older clients send short strings."""
+    if isinstance(req_id, bytes):
+        return req_id.hex()
+    return str(req_id)
+
+
+class PendingRequests:
+    """Requests waiting for a reply, by req_id. Every entry has a deadline
+    and is dropped once it passed, so replies that never come do not leave
+    entries behind. len() is the number of pending requests.
+
+    Ids are 8 bytes: a random nonce picked once per table, which keeps them
+    apart from ids of earlier runs, and a counter, which keeps them apart
+    from each other.
+
+    add() and expire() are called from the event loop, get() and pop()
+    also from the RNS threads that deliver replies."""
+
+    def __init__(self):
+        self.nonce = os.urandom(4)
+        self.counter = 0
+        self.entries = {}  # req_id -> (value, deadline)
+        # (deadline, req_id), entries that were popped or re-added with a
+        # new deadline stay here until they come up and are skipped
+        self.deadlines = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def new_id(self):
+        self.counter = (self.counter + 1) & 0xFFFFFFFF
+        return self.nonce + struct.pack(">I", self.counter)
+
+    def add(self, req_id, value, deadline):
+        """Adds or replaces the entry for req_id, it expires at deadline
+        (a time.time() timestamp)."""
+        self.expire()
+        self.entries[req_id] = (value, deadline)
+        heapq.heappush(self.deadlines, (deadline, req_id))
+
+    def get(self, req_id):
+        entry = self.entries.get(req_id)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def pop(self, req_id):
+        entry = self.entries.pop(req_id, None)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def expire(self, now=None):
+        """Drops the entries whose deadline passed, returns their values."""
+        if now is None:
+            now = time.time()
+        expired = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            deadline, req_id = heapq.heappop(self.deadlines)
+            entry = self.entries.get(req_id)
+            # entries re-added with a later deadline stay. pop, not del: a
+            # RNS thread may have popped the entry since we got it
+            if (
+                entry is not None
+                and entry[1] == deadline
+                and self.entries.pop(req_id, None) is not None
+            ):
+                expired.append(entry[0])
+        return expired
+
+    def values(self):
+        return [value for value, _ in list(self.entries.values())]
@@ -0,0 +1,62 @@
+from url_routing import RoutingTable, is_read_only
+
+MAPPINGS = {
+    "https://8333.space": "aa",
+    "https://8333.space/Bitcoin": ["bb", "cc"],
+    "https://mint.example/": "dd",
+}
+
+
+def test_nested_prefixes():
+    table = RoutingTable(MAPPINGS)
+    assert table.route("https://8333.space/Bitcoin/keys") == (("bb", "cc"), "/keys")
+    assert table.route("https://8333.space/Bitcoin") == (("bb", "cc"), "")
+    assert table.route("https://8333.space/keys") == (("aa",), "/keys")
+
+
+def test_prefix_ends_at_segment():
+    table = RoutingTable(MAPPINGS)
+    assert table.route("https://8333.space/BitcoinCash/keys") == (
+        ("aa",),
+        "/BitcoinCash/keys",
+    )
+    assert table.route("https://mint.example/keys") == (("dd",), "keys")
+
+
+def test_other_port_is_not_mapped():
+    table = RoutingTable(MAPPINGS)
+    url = "https://8333.space:3338/keys"
+    assert table.route(url) == (None, url)
+
+
+def test_sibling_host_is_not_mapped():
+    table = RoutingTable(MAPPINGS)
+    url = "https://8333.space.evil/keys"
+    assert table.route(url) == (None, url)
+
+
+def test_query_string():
+    table = RoutingTable(MAPPINGS)
+    assert table.route("https://8333.space/Bitcoin?x=1") == (("bb", "cc"), "?x=1")
+    assert table.route("https://8333.space?x=1") == (("aa",), "?x=1")
+
+
+def test_cached_lookups_match():
+    table = RoutingTable(MAPPINGS, cache_size=1)
+    for _ in range(2):
+        assert table.route("https://8333.space/Bitcoin/info") == (
+            ("bb", "cc"),
+            "/info",
+        )
+        assert table.route("https://8333.space:3338") == (
+            None,
+            "https://8333.space:3338",
+        )
+
+
+def test_read_only_paths():
+    assert is_read_only("/keys")
+    assert is_read_only("/keys/009a1f293253e41e")
+    assert is_read_only("/keysets?x=1")
+    assert not is_read_only("/mint")
+    assert not is_read_only("/split")
@@ -0,0 +1,258 @@
+"""Round trips of the wire format. Both sides of a radio link may run
+different versions, so any change here has to be deliberate."""
+
+import json
+
+import pytest
+import RNS.vendor.umsgpack as umsgpack
+
+import cashu_packing
+import lxmf_codec
+from lxmf_codec import (
+    CODEC_NONE,
+    CODEC_ZLIB,
+    CODEC_ZSTD_DICT,
+    SCHEMA_CASHU,
+    WIRE_VERSION,
+    decode_batch_response,
+    decode_request,
+    decode_requests,
+    decode_response,
+    encode_batch_request,
+    encode_batch_response,
+    encode_request,
+    encode_response,
+    pack_envelope,
+    unpack_envelope,
+)
+
+# cashu_packing.KEYS as released, the wire codes of these names must
+# never change
+RELEASED_KEYS = (
+    "id",
+    "amount",
+    "secret",
+    "C",
+    "B_",
+    "C_",
+    "dleq",
+    "e",
+    "s",
+    "r",
+    "witness",
+    "proofs",
+    "outputs",
+    "promises",
+    "pr",
+    "spendable",
+    "pending",
+    "keysets",
+    "paid",
+    "preimage",
+    "change",
+    "detail",
+    "code",
+    "hash",
+    "payment_hash",
+    "fee",
+    "states",
+    "Y",
+    "state",
+    "quote",
+    "unit",
+    "name",
+    "pubkey",
+    "version",
+    "description",
+    "description_long",
+    "contact",
+    "motd",
+    "nuts",
+    "parameter",
+    "signatures",
+    "current",
+    "active",
+    "keys",
+)
+
+POINT = "02" + "ab" * 32
+SECRET = "cd" * 32
+KEYSET_ID = "009a1f293253e41e"
+
+SPLIT_REQUEST = {
+    "proofs": [
+        {
+            "id": KEYSET_ID,
+            "amount": 8,
+            "secret": SECRET,
+            "C": POINT,
+            "dleq": {"e": "11" * 32, "s": "22" * 32, "r": "33" * 32},
+        },
+        {"id": KEYSET_ID, "amount": 2, "secret": "not hex", "C": POINT},
+    ],
+    "outputs": [{"id": KEYSET_ID, "amount": 2, "B_": POINT}] * 5,
+}
+
+KEYS_REPLY = {
+    "keysets": [
+        {"id": KEYSET_ID, "unit": "sat", "keys": {"1": POINT, "2": POINT}},
+    ]
+}
+
+CODECS = [CODEC_NONE, CODEC_ZLIB] + (
+    [lxmf_codec.CODEC_ZSTD] if lxmf_codec.zstandard is not None else []
+)
+
+
+def test_released_keys_are_kept():
+    assert cashu_packing.KEYS[: len(RELEASED_KEYS)] == RELEASED_KEYS
+    assert cashu_packing.KEY_CODES["id"] == -1
+    assert cashu_packing.KEY_CODES["keys"] == -len(RELEASED_KEYS)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        SPLIT_REQUEST,
+        KEYS_REPLY,
+        {"detail": "Token already spent.", "code": 11001},
+        {"keysets": ["00abc", "not hex"], "current": "ABCD"},
+    ],
+)
+def test_pack_roundtrip(body):
+    packed = cashu_packing.pack(body)
+    assert cashu_packing.unpack(umsgpack.unpackb(umsgpack.packb(packed))) == body
+
+
+def test_pack_shrinks_hex():
+    packed = cashu_packing.pack(SPLIT_REQUEST)
+    proof = packed[cashu_packing.KEY_CODES["proofs"]][0]
+    assert proof[cashu_packing.KEY_CODES["secret"]] == bytes.fromhex(SECRET)
+    assert len(umsgpack.packb(packed)) < len(json.dumps(SPLIT_REQUEST)) / 2
+
+
+def test_envelope_header():
+    payload = {"m": "GET", "u": "/keys"}
+    assert pack_envelope(payload) == bytes([WIRE_VERSION, CODEC_NONE]) + umsgpack.packb(
+        payload
+    )
+    assert decode_request(pack_envelope(payload))["path"] == "/keys"
+
+
+def test_envelope_rejects_unknown_version():
+    with pytest.raises(ValueError):
+        unpack_envelope(bytes([WIRE_VERSION + 1, CODEC_NONE]) + umsgpack.packb({}))
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("schema", [None, SCHEMA_CASHU])
+def test_request_roundtrip(codec, schema):
+    envelope = encode_request(
+        "POST",
+        "/split",
+        codec,
+        params={"a": "1"},
+        headers={"X-Keys-Format": "xpub"},
+        json=SPLIT_REQUEST,
+        schema=schema,
+    )
+    assert decode_request(envelope) == {
+        "method": "POST",
+        "path": "/split",
+        "params": {"a": "1"},
+        "headers": {"X-Keys-Format": "xpub"},
+        "cookies": None,
+        "data": None,
+        "json": SPLIT_REQUEST,
+    }
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_batch_request_roundtrip(codec):
+    envelope = encode_batch_request(
+        [
+            dict(method="GET", path="/keys"),
+            dict(method="GET", path="/keysets"),
+            dict(method="POST", path="/split", json=SPLIT_REQUEST),
+        ],
+        codec,
+        schema=SCHEMA_CASHU,
+    )
+    requests, is_batch = decode_requests(envelope)
+    assert is_batch
+    assert [(r["method"], r["path"]) for r in requests] == [
+        ("GET", "/keys"),
+        ("GET", "/keysets"),
+        ("POST", "/split"),
+    ]
+    assert requests[2]["json"] == SPLIT_REQUEST
+    assert decode_requests(encode_request("GET", "/info", codec))[1] is False
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("schema", [None, SCHEMA_CASHU])
+def test_response_roundtrip(codec, schema):
+    envelope = encode_response(200, json.dumps(KEYS_REPLY), codec, schema)
+    assert decode_response(envelope) == (200, KEYS_REPLY, True, {})
+
+
+def test_error_response_roundtrip():
+    error = {"detail": "Token already spent.", "code": 11001}
+    headers = {"content-type": "application/json", "retry-after": "5"}
+    envelope = encode_response(
+        400, json.dumps(error), CODEC_ZLIB, SCHEMA_CASHU, headers=headers
+    )
+    assert decode_response(envelope) == (400, error, True, headers)
+    envelope = encode_response(502, "Bad Gateway", CODEC_NONE)
+    assert decode_response(envelope) == (502, "Bad Gateway", False, {})
+
+
+def test_batch_response_roundtrip():
+    envelope = encode_batch_response(
+        [
+            (200, json.dumps(KEYS_REPLY), None),
+            None,
+            (503, json.dumps({"detail": "busy"}), {"retry-after": "2"}),
+        ],
+        CODEC_ZLIB,
+        SCHEMA_CASHU,
+    )
+    assert decode_batch_response(envelope) == [
+        (200, KEYS_REPLY, True, {}),
+        None,
+        (503, {"detail": "busy"}, True, {"retry-after": "2"}),
+    ]
+
+
+@pytest.fixture
+def dictionary(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    samples = [
+        umsgpack.packb(
+            lxmf_codec.request_payload(
+                "POST",
+                f"/split/{i}",
+                json={
+                    "outputs": [
+                        {"id": KEYSET_ID, "amount": 2**j, "B_": f"{i:02x}" * 33}
+                        for j in range(i % 8 + 1)
+                    ]
+                },
+            )
+        )
+        for i in range(300)
+    ]
+    trained = zstandard.train_dictionary(4096, samples)
+    (tmp_path / f"test{lxmf_codec.DICTIONARY_SUFFIX}").write_bytes(trained.as_bytes())
+    lxmf_codec.load_dictionaries(tmp_path)
+    yield trained.dict_id()
+    lxmf_codec.load_dictionaries()
+
+
+def test_dictionary_envelope_roundtrip(dictionary):
+    body = {"outputs": [{"id": KEYSET_ID, "amount": 4, "B_": POINT}]}
+    envelope = encode_request(
+        "POST", "/split", CODEC_ZLIB, dictionary_id=dictionary, json=body
+    )
+    assert envelope[1] == CODEC_ZSTD_DICT
+    assert decode_request(envelope)["json"] == body
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Trains a zstd dictionary for the LXMF envelope from traffic recorded
+by the proxy (lxmf_proxy_server.py --record-dir <dir>).
+
+    python3 train_dictionary.py <samples_dir> <dictionary_id> [--size 4096]
+
+The dictionary is written to dictionaries/<dictionary_id>.zdict. Copy the
+same file to the proxy and to the wallets, both sides only use dictionaries
+they both have, so new versions can be rolled out next to the old ones.
+"""
+
+import argparse
+import os
+import sys
+
+import zstandard
+
+from lxmf_codec import DICTIONARY_DIR, DICTIONARY_SUFFIX
+
+
+def load_samples(directory):
+    samples = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".msgpack"):
+            continue
+        with open(os.path.join(directory, filename), "rb") as f:
+            samples.append(f.read())
+    return samples
+
+
+def compressed_size(samples, dictionary=None):
+    if dictionary is None:
+        compressor = zstandard.ZstdCompressor(level=19)
+    else:
+        compressor = zstandard.ZstdCompressor(level=19, dict_data=dictionary)
+    return sum(min(len(compressor.compress(s)), len(s)) for s in samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Trains a zstd dictionary from recorded LXMF proxy traffic"
+    )
+    parser.add_argument("samples_dir")
+    parser.add_argument("dictionary_id", type=int)
+    parser.add_argument("--size", type=int, default=4096, help="dictionary size")
+    parser.add_argument("--output-dir", default=DICTIONARY_DIR)
+    args = parser.parse_args()
+
+    if not 0 < args.dictionary_id < 2**31:
+        print("Dictionary id must be between 1 and 2^31 - 1")
+        sys.exit(1)
+
+    samples = load_samples(args.samples_dir)
+    if len(samples) < 10:
+        print(f"Need at least 10 samples to train, found {len(samples)}")
+        sys.exit(1)
+
+    # Evaluate on every fifth sample, train on the rest
+    test_samples = samples[::5]
+    train_samples = [s for i, s in enumerate(samples) if i % 5 != 0]
+
+    dictionary = zstandard.train_dictionary(
+        args.size, train_samples, dict_id=args.dictionary_id
+    )
+
+    raw = sum(len(s) for s in test_samples)
+    plain = compressed_size(test_samples)
+    with_dictionary = compressed_size(test_samples, dictionary)
+    print(f"Trained on {len(train_samples)} samples, tested on {len(test_samples)}")
+    print(f"Uncompressed:     {raw} bytes")
+    print(f"zstd:             {plain} bytes")
+    print(f"zstd+dictionary:  {with_dictionary} bytes")
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    path = os.path.join(args.output_dir, f"{args.dictionary_id}{DICTIONARY_SUFFIX}")
+    with open(path, "wb") as f:
+        f.write(dictionary.as_bytes())
+    print(f"Wrote dictionary {args.dictionary_id} to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Maps mint URLs to the LXMF destinations of their proxies.
+
+The mappings are URL prefixes. A URL is routed by the longest prefix it
+starts with, so a mapping for https://mint.example/Bitcoin wins over one
+for https://mint.example for URLs under both. A prefix only matches whole
+path segments: https://mint.example/B does not match
+https://mint.example/Bitcoin/keys. A prefix maps to one proxy
+destination (hex) or to a list of them, proxies that all serve the mint.
+"""
+
+import collections
+import re
+
+# Characters that may follow a prefix in the URLs it matches. Not ":", a
+# host with another port is another mint.
+BOUNDARIES = "/?"
+
+# Requests that only read the mint's state, any proxy of the mint can
+# answer them
+READ_ONLY_PATH = re.compile(r"^/(keys(/[^/?]+)?|keysets|info|check)(\?.*)?$")
+
+
+def destinations_of(value):
+    """The destinations of a mapping, as a tuple."""
+    if isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
+
+def all_destinations(mappings):
+    """All the destinations mappings refer to, as a set."""
+    return {
+        destination
+        for value in mappings.values()
+        for destination in destinations_of(value)
+    }
+
+
+def at_boundary(url, length):
+    """True if url[:length] ends a whole part of url: url ends there, or
+    the next character or the prefix's own last one separates parts."""
+    return length == len(url) or url[length] in BOUNDARIES or url[length - 1] == "/"
+
+
+def is_read_only(path):
+    """True for requests (path relative to the mapping) that do not change
+    anything at the mint."""
+    return READ_ONLY_PATH.match(path) is not None
+
+
+class RoutingTable:
+    """Longest-prefix lookups in a dict of URL prefix -> destination or
+    list of destinations.
+
+    Prefixes are kept in one dict per prefix length. A lookup tries the
+    URL's own prefixes from the longest length down, one dict lookup per
+    distinct length, however many mappings there are. The last cache_size
+    results are cached, wallets ask for the same few URLs over and over."""
+
+    def __init__(self, mappings, cache_size=1024):
+        self.by_length = collections.defaultdict(dict)
+        for prefix, destination in mappings.items():
+            self.by_length[len(prefix)][prefix] = destinations_of(destination)
+        self.lengths = sorted(self.by_length, reverse=True)
+        self.cache_size = cache_size
+        # url -> (prefix, destinations)
+        self.cache = collections.OrderedDict()
+
+    def lookup(self, url):
+        """Returns (prefix, tuple of destinations) of the longest prefix url
+        starts with, (None, None) if there is none."""
+        result = self.cache.get(url)
+        if result is not None:
+            self.cache.move_to_end(url)
+            return result
+        result = (None, None)
+        for length in self.lengths:
+            if length > len(url) or not at_boundary(url, length):
+                continue
+            destinations = self.by_length[length].get(url[:length])
+            if destinations is not None:
+                result = (url[:length], destinations)
+                break
+        self.cache[url] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+    def route(self, url):
+        """Returns (tuple of destinations, url relative to the prefix), or
+        (None, url) if url is not mapped."""
+        prefix, destinations = self.lookup(url)
+        if destinations is None:
+            return (None, url)
+        return (destinations, url[len(prefix) :])
@@ -0,0 +1,37 @@
+import hashlib
+
+from bip32 import BIP32
+
+# Request header the wallet sends on GET /keys and /keys/{id} to say it can
+# derive the keys itself. A proxy that knows the keyset's xpub strips it and
+# replies with xpub_keys_reply() instead of the full amount -> public key map.
+KEYS_FORMAT_HEADER = "X-Keys-Format"
+KEYS_FORMAT_XPUB = "xpub"
+
+# Key for amount 2^i is the non-hardened child i of the xpub: xpub/i
+SCHEME_BIP32_POW2 = "bip32-pow2"
+
+
+def derive_public_keys(xpub, count, scheme=SCHEME_BIP32_POW2):
+    """Derives the public keys for amounts 1, 2, 4, ... 2^(count-1) from
+    the extended public key. Returns a dict of amount -> 33 byte public key."""
+    if scheme != SCHEME_BIP32_POW2:
+        raise ValueError(f"Unsupported keyset derivation scheme {scheme}")
+    bip32 = BIP32.from_xpub(xpub)
+    return {2**i: bip32.get_pubkey_from_path(f"m/{i}") for i in range(count)}
+
+
+def xpub_keys_reply(xpub, count, keyset_id, scheme=SCHEME_BIP32_POW2):
+    """The body the proxy sends instead of the full keyset."""
+    return {"xpub": xpub, "scheme": scheme, "n": count, "id": keyset_id}
+
+
+def is_xpub_keys_reply(keys):
+    return isinstance(keys, dict) and "xpub" in keys
+
+
+def compute_keyset_id(public_keys):
+    """Keyset id of a dict of amount -> 33 byte public key, computed the
+    same way as cashu's derive_keyset_id."""
+    pubkeys_concat = b"".join(public_keys[amount] for amount in sorted(public_keys))
+    return "00" + hashlib.sha256(pubkeys_concat).hexdigest()[:14]